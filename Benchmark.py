@@ -0,0 +1,283 @@
+import json
+import math
+import multiprocessing
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from functools import partial
+
+import numpy
+
+import Contrast
+import IO
+import ImageProcessingTools
+import PresetMethods
+import Video
+
+# --------------------------------------------------------------------------------------------------------------
+# ---------------------------Synthetic Inputs ------------------------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------
+
+
+def synthetic_image(megapixels: float, channels: int = 3, dtype: str = 'uint8', seed: int = 0) -> numpy.ndarray:
+    """
+    Image of roughly [megapixels] million pixels at a 3:2 aspect ratio, a smooth gradient with hard edges and noise
+    so stdev outputs and encoded file sizes are close to those of photographs
+    :param channels: 1 for a 2d greyscale image, 3 for (h, w, 3)
+    :param dtype: 'uint8' or 'uint16'
+    """
+    height = max(int(math.sqrt(megapixels * 1e6 * 2 / 3)), 1)
+    width = max(int(megapixels * 1e6 / height), 1)
+    peak = numpy.iinfo(dtype).max
+    rng = numpy.random.default_rng(seed)
+    image = numpy.empty((height, width, channels), dtype=dtype)
+    x = numpy.linspace(0, 1, width, dtype=numpy.float32)
+    for start in range(0, height, 256):  # built in blocks of rows so large images don't need float copies
+        stop = min(start + 256, height)
+        y = numpy.linspace(start / height, stop / height, stop - start, endpoint=False, dtype=numpy.float32)
+        block = (x[None, :] + y[:, None]) / 2
+        block = block + (numpy.sin(x[None, :] * 40) > 0.5) * 0.25  # vertical bars give hard edges
+        block = block[:, :, None] * numpy.linspace(0.6, 1, channels, dtype=numpy.float32)
+        block += rng.normal(0, 0.04, block.shape).astype(numpy.float32)
+        image[start:stop] = numpy.clip(block, 0, 1) * peak
+    return image[:, :, 0] if channels == 1 else image
+
+
+def _as_bgr8(image: numpy.ndarray) -> numpy.ndarray:
+    """ 3 channel uint8 version of an image, the only format video files are written in """
+    if image.dtype != numpy.uint8:
+        image = (image >> 8).astype(numpy.uint8)
+    return numpy.dstack([image] * 3) if image.ndim == 2 else image
+
+
+def synthetic_clip(file: pathlib.Path, image: numpy.ndarray, frames: int = 30) -> pathlib.Path:
+    """ write a clip of [image] drifting sideways, :return: the file written """
+    image = _as_bgr8(image)
+    IO.export_video(file, (numpy.roll(image, i * 4, axis=1) for i in range(frames)))
+    return file.with_suffix('.avi')
+
+
+# --------------------------------------------------------------------------------------------------------------
+# ---------------------------Cases -----------------------------------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------
+# each case takes the synthetic image and a scratch folder, does any setup and returns
+# (function to time, megapixels processed by one call of it)
+video_frames = 30
+
+
+def _single_pass(image: numpy.ndarray, directory: pathlib.Path):
+    """ includes decoding the file as single_pass does, 16 bit files are decoded to 8 bit by IO.load_image """
+    file = directory / 'single_pass.png'
+    IO.export_image(file, image)
+    return partial(ImageProcessingTools.single_pass, file.as_posix(), '', image.ndim == 3, 9,
+                   return_image=True), image.shape[0] * image.shape[1] / 1e6
+
+
+def _multi_pass(image: numpy.ndarray, directory: pathlib.Path):
+    file = directory / 'multi_pass.png'
+    IO.export_image(file, image)
+    return partial(ImageProcessingTools.multi_pass, file.as_posix(), '', image.ndim == 3, [3, 5, 7, 9, 11], 'dist',
+                   return_image=True), image.shape[0] * image.shape[1] / 1e6
+
+
+def _preset(name: str, image: numpy.ndarray, directory: pathlib.Path):
+    plan = PresetMethods.PresetPlan({name: PresetMethods.named_methods[name]})
+    return lambda: dict(plan.apply(image)), image.shape[0] * image.shape[1] / 1e6
+
+
+def _image_cache_miss(image: numpy.ndarray, directory: pathlib.Path):
+    """ first request of a window, builds the running sums """
+    return lambda: Contrast.ImageCache(image)(9), image.shape[0] * image.shape[1] / 1e6
+
+
+def _image_cache_hit(image: numpy.ndarray, directory: pathlib.Path):
+    cache = Contrast.ImageCache(image)
+    cache(9)
+    return lambda: cache(9), image.shape[0] * image.shape[1] / 1e6
+
+
+def _combine_array_list(image: numpy.ndarray, directory: pathlib.Path):
+    """ combine of the seven window results of cont_48's largest group """
+    cache = Contrast.ImageCache(image)
+    arrays = [cache(w) for w in (3, 5, 7, 9, 11, 13, 15)]
+    return lambda: Contrast.combine_array_list(arrays, 'dist'), image.shape[0] * image.shape[1] / 1e6
+
+
+def _io_export(image: numpy.ndarray, directory: pathlib.Path):
+    return partial(IO.export_image, directory / 'export.png', image), image.shape[0] * image.shape[1] / 1e6
+
+
+def _io_load(image: numpy.ndarray, directory: pathlib.Path):
+    file = directory / 'load.png'
+    IO.export_image(file, image)
+    return partial(IO.load_image, file, image.ndim == 3), image.shape[0] * image.shape[1] / 1e6
+
+
+def _video(image: numpy.ndarray, directory: pathlib.Path):
+    """ decode, moving stdev per frame and encode """
+    clip = synthetic_clip(directory / 'clip.avi', image, video_frames)
+    return (partial(Video.apply_without_ram_buffer, clip, directory / 'video_out.avi', Contrast.moving_stdev,
+                    window=9),
+            video_frames * image.shape[0] * image.shape[1] / 1e6)
+
+
+def _video_temporal(image: numpy.ndarray, directory: pathlib.Path):
+    clip = synthetic_clip(directory / 'clip.avi', image, video_frames)
+    return (partial(Video.apply_temporal, clip, directory / 'temporal_out.avi', 5),
+            video_frames * image.shape[0] * image.shape[1] / 1e6)
+
+
+cases: dict[str, Callable] = {
+    'single_pass': _single_pass,
+    'multi_pass': _multi_pass,
+    **{f'preset:{name}': partial(_preset, name) for name in PresetMethods.named_methods},
+    'image_cache_miss': _image_cache_miss,
+    'image_cache_hit': _image_cache_hit,
+    'combine_array_list': _combine_array_list,
+    'io_export': _io_export,
+    'io_load': _io_load,
+    'video': _video,
+    'video_temporal': _video_temporal,
+}
+
+
+# --------------------------------------------------------------------------------------------------------------
+# ---------------------------Running ---------------------------------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------
+
+
+def peak_rss_mb() -> float or None:
+    """ peak resident memory of this process in MB, None where the resource module is missing (Windows) """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KB elsewhere
+
+
+def run_case(case: str, megapixels: float, channels: int, dtype: str, repeats: int = 3) -> dict:
+    """
+    Time one case, run in a fresh process by run_suite so peak memory belongs to this case alone
+    :return: result record, seconds is the fastest of [repeats] calls
+    """
+    record = {'case': case, 'megapixels': megapixels, 'channels': channels, 'dtype': dtype}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            function, processed = cases[case](synthetic_image(megapixels, channels, dtype), pathlib.Path(directory))
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                function()
+                times.append(time.perf_counter() - start)
+    except Exception as e:  # e.g. MemoryError on the largest sizes, recorded so the rest of the suite still runs
+        record['error'] = f'{type(e).__name__}: {e}'
+        return record
+    record['seconds'] = min(times)
+    record['mp_per_s'] = processed / record['seconds']
+    record['peak_rss_mb'] = peak_rss_mb()
+    return record
+
+
+def run_suite(names: list[str], sizes: list[float], channel_counts: list[int], dtypes: list[str],
+              repeats: int = 3) -> dict:
+    """
+    Run every combination of case, size, channel count and dtype, each in its own process
+    :return: {'machine': {...}, 'results': [record, ...]}
+    """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for megapixels in sizes:
+        for channels in channel_counts:
+            for dtype in dtypes:
+                for case in names:
+                    with context.Pool(1) as pool:
+                        record = pool.apply(run_case, (case, megapixels, channels, dtype, repeats))
+                    results.append(record)
+                    print(format_record(record))
+    machine = {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': numpy.__version__,
+               'cpu_count': multiprocessing.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    return {'machine': machine, 'results': results}
+
+
+def format_record(record: dict) -> str:
+    name = f"{record['case']:<22} {record['megapixels']:>6}MP {record['channels']}ch {record['dtype']:<6}"
+    if 'error' in record:
+        return f"{name} {record['error']}"
+    rss = 'n/a' if record['peak_rss_mb'] is None else f"{record['peak_rss_mb']:.0f}MB"
+    return f"{name} {record['seconds']:>9.4f}s {record['mp_per_s']:>9.2f}MP/s  peak {rss}"
+
+
+def compare(baseline: dict, results: dict, threshold: float = 0.1) -> list[str]:
+    """
+    Compare two runs of the suite case by case
+    :param threshold: allowed fractional loss of MP/s or growth of peak memory before a case is flagged
+    :return: description of every regression
+    """
+    def key(record):
+        return record['case'], record['megapixels'], record['channels'], record['dtype']
+
+    base = {key(record): record for record in baseline['results'] if 'error' not in record}
+    regressions = []
+    for record in results['results']:
+        old = base.get(key(record))
+        if old is None or 'error' in record:
+            continue
+        speed = record['mp_per_s'] / old['mp_per_s']
+        line = f"{format_record(record)}  speed x{speed:.2f}"
+        flags = []
+        if speed < 1 - threshold:
+            flags.append(f"{old['mp_per_s']:.2f}MP/s -> {record['mp_per_s']:.2f}MP/s")
+        if old['peak_rss_mb'] and record['peak_rss_mb']:
+            line += f"  memory x{record['peak_rss_mb'] / old['peak_rss_mb']:.2f}"
+            if record['peak_rss_mb'] > old['peak_rss_mb'] * (1 + threshold):
+                flags.append(f"peak {old['peak_rss_mb']:.0f}MB -> {record['peak_rss_mb']:.0f}MB")
+        print(line + ('  REGRESSION' if flags else ''))
+        if flags:
+            regressions.append(f"{' '.join(map(str, key(record)))}: {', '.join(flags)}")
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="time the processing stages on synthetic images and clips")
+    parser.add_argument("-c", "--cases", dest="cases",
+                        help=f"cases to run separated by ',' or 'all', a name ending in ':' selects every case "
+                             f"starting with it, e.g. 'preset:'. options: {', '.join(cases)}",
+                        default='all')
+    parser.add_argument("-s", "--sizes", dest="sizes", help="image sizes in megapixels separated by ','",
+                        default='1,12')
+    parser.add_argument("-ch", "--channels", dest="channels", help="channel counts separated by ',', 1 or 3",
+                        default='3')
+    parser.add_argument("-dt", "--dtypes", dest="dtypes", help="bit depths separated by ',', uint8 or uint16",
+                        default='uint8')
+    parser.add_argument("-r", "--repeats", dest="repeats", help="calls timed per case, the fastest is kept",
+                        type=int, default=3)
+    parser.add_argument("-o", "--output", dest="output", help="json file to save results to")
+    parser.add_argument("-i", "--input", dest="input", help="json file of stored results to compare instead of running")
+    parser.add_argument("-cmp", "--compare", dest="compare", help="json file of baseline results to compare against")
+    parser.add_argument("-th", "--threshold", dest="threshold",
+                        help="fractional loss of speed or growth of memory flagged as a regression",
+                        type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.input:
+        suite = json.loads(pathlib.Path(args.input).read_text())
+    else:
+        if args.cases.strip().lower() == 'all':
+            selected = list(cases)
+        else:
+            selected = [name for part in args.cases.split(',') for name in cases
+                        if name == part or (part.endswith(':') and name.startswith(part))]
+        suite = run_suite(selected, [float(s) for s in args.sizes.split(',')],
+                          [int(c) for c in args.channels.split(',')], args.dtypes.split(','), args.repeats)
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(suite, indent=1))
+    if args.compare:
+        found = compare(json.loads(pathlib.Path(args.compare).read_text()), suite, args.threshold)
+        print(f"{'-' * 20}\n{len(found)} regression(s)" + ''.join(f"\n\t{line}" for line in found))
+        sys.exit(1 if found else 0)
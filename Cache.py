@@ -0,0 +1,127 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+
+import numpy
+
+import Profile
+
+
+class DiskCache:
+    """
+    Content addressed store of arrays on disk, shared between runs.
+    Keys are hashes of the input content and every parameter that affects a result, arrays are stored as raw .npy
+    files. When the store grows past max_bytes the least recently used entries are removed.
+    """
+
+    def __init__(self, directory: pathlib.Path or str, max_bytes: int = 10 * 2 ** 30):
+        """
+        :param directory: folder holding the cache, created if missing
+        :param max_bytes: size budget of the cache
+        """
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()  # threads of a stream pipeline or daemon share one cache
+        self.size = sum(path.stat().st_size for path in self._entries())
+
+    def __getstate__(self) -> dict:
+        # locks can't be pickled, a cache handed to a worker process gets a lock of its own
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return f"DiskCache({self.directory.as_posix()}, {self.size}/{self.max_bytes} bytes)"
+
+    @staticmethod
+    def key(*parts) -> str:
+        """ key for a result, parts should be hashes of the inputs and the parameters used """
+        return hashlib.blake2b(repr(parts).encode(), digest_size=20).hexdigest()
+
+    @staticmethod
+    def hash_file(file: pathlib.Path) -> str:
+        """ hash of the content of a file, lets cached outputs be found without decoding the file """
+        digest = hashlib.blake2b(digest_size=20)
+        with open(file, 'rb') as f:
+            while chunk := f.read(2 ** 20):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_array(array: numpy.ndarray) -> str:
+        """ hash of the shape, dtype and content of an array """
+        digest = hashlib.blake2b(repr((array.shape, array.dtype.str)).encode(), digest_size=20)
+        digest.update(numpy.ascontiguousarray(array).data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / f"{key}.npy"
+
+    def _entries(self) -> list[pathlib.Path]:
+        return list(self.directory.glob('*/*.npy'))
+
+    @Profile.stage('disk_cache', lambda self, key: 'get')
+    def get(self, key: str) -> numpy.ndarray or None:
+        """ :return: the stored array, or None if the key is not in the cache """
+        path = self._path(key)
+        try:
+            array = numpy.load(path)
+            os.utime(path)  # modification time marks the last use for eviction
+        except (FileNotFoundError, ValueError, EOFError):  # missing, or removed by another process mid read
+            return None
+        return array
+
+    @Profile.stage('disk_cache', lambda self, key, array: 'put')
+    def put(self, key: str, array: numpy.ndarray):
+        """ store an array, entries larger than the whole budget are not stored """
+        if array.nbytes > self.max_bytes:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # write then rename so other processes never read a partial file, the name is unique to this write so
+        # threads storing the same key don't replace each other's temporary file
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=path.parent)
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                numpy.save(f, numpy.ascontiguousarray(array))
+            with self.lock:
+                new = not path.exists()
+                os.replace(temporary, path)
+                if new:  # overwriting an entry with the same key doesn't grow the cache
+                    self.size += path.stat().st_size
+                if self.size > self.max_bytes:
+                    self.evict()
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+    def evict(self):
+        """ remove least recently used entries until the cache is below 90% of its budget """
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                path.unlink()
+            except (FileNotFoundError, PermissionError):  # already gone, or open elsewhere on windows
+                continue
+            self.size -= size
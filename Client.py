@@ -0,0 +1,77 @@
+import json
+import pathlib
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Thin client for Daemon.py, only the standard library is imported so sending a job costs no numpy or cv2 start up.
+# Jobs are validated by the daemon, see Daemon.Job for the layout.
+default_address = ('127.0.0.1', 8765)
+
+
+def _call(url: str, data: bytes or None = None, timeout: float or None = None) -> dict:
+    request = urllib.request.Request(url, data, {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:  # failed and invalid jobs still reply with a json body
+        return json.loads(e.read())
+
+
+def submit(job: dict, address: tuple[str, int] = default_address, timeout: float or None = None) -> dict:
+    """ send a job to a running daemon and wait for it to finish, :return: the job result, with 'error' if failed """
+    return _call(f'http://{address[0]}:{address[1]}/job', json.dumps(job).encode(), timeout)
+
+
+def submit_all(jobs: list[dict], address: tuple[str, int] = default_address, connections: int = 64) -> list[dict]:
+    """
+    send jobs together so the daemon can batch them, with at most [connections] jobs waiting at a time, each held
+    job takes a thread and a connection on both sides. A few batches worth keeps the daemon busy
+    :return: results in the order of jobs
+    """
+    with ThreadPoolExecutor(max(min(len(jobs), connections), 1)) as pool:
+        return list(pool.map(lambda job: submit(job, address), jobs))
+
+
+def status(address: tuple[str, int] = default_address) -> dict:
+    """ :return: queue depth, jobs running, completed and failed, and latency of the daemon """
+    return _call(f'http://{address[0]}:{address[1]}/status')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="send jobs to Daemon.py")
+    parser.add_argument("-port", "--port", dest="port", type=int, default=default_address[1])
+    parser.add_argument("-status", "--status", dest="status", help="print the queue depth and latency of the daemon",
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("-f", "--files", dest="files", help="input files separated by ',', one job per file")
+    parser.add_argument("-o", "--output", dest="output",
+                        help="output file for a single input, or output folder for several")
+    parser.add_argument("-w", "--window", dest="window", help="window size, int or list[int]", default='3')
+    parser.add_argument("-combine", "--combiner_options", dest="combine_options",
+                        help="method used to combine multi-pass images, prepend '-' to invert list", default="sum")
+    parser.add_argument("-k", "--kernel", dest="kernel", help="'line' or 'box2d'", default="line")
+    parser.add_argument("-rgb", "--rgb", dest="rgb", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("-preset", "--preset", dest="preset",
+                        help="run named presets instead of a pass, separated by ','")
+    args = parser.parse_args()
+    address = default_address[0], args.port
+
+    if args.status:
+        print(json.dumps(status(address), indent=1))
+    else:
+        files = [pathlib.Path(f).resolve() for f in args.files.split(',')]  # the daemon may run from elsewhere
+        windows = [int(w) for w in args.window.split(',')]
+        jobs = []
+        for file in files:
+            if args.preset:
+                jobs.append({'kind': 'preset', 'file': file.as_posix(), 'methods': args.preset.split(',')})
+                continue
+            output = pathlib.Path(args.output).resolve()
+            jobs.append({'kind': 'single_pass' if len(windows) == 1 else 'multi_pass', 'file': file.as_posix(),
+                         'output': (output if len(files) == 1 else output / file.name).as_posix(),
+                         'window': windows[0] if len(windows) == 1 else windows,
+                         'combine': args.combine_options, 'kernel': args.kernel, 'rgb': args.rgb})
+        for result in submit_all(jobs, address):
+            print(result)
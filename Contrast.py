@@ -1,67 +1,630 @@
-import math
+import multiprocessing
+from collections import OrderedDict
 from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 import bottleneck
 import numpy
-from cv2 import cv2
+
+import Profile
 
 
 class ImageCache:
-    def __init__(self, image: numpy.ndarray):
+    def __init__(self, image: numpy.ndarray, disk_cache=None, max_bytes: int or None = None,
+                 precision: str or None = None):
+        """
+        :param image: image array
+        :param disk_cache: optional Cache.DiskCache, results are shared with every other run on the same image
+        :param max_bytes: memory budget of cached results and of the running sum tables they are computed from,
+            least recently used results are dropped first, results with no reads planned through expect() go first,
+            then tables with no planned reads, then results still waiting to be read and last the other tables
+        :param precision: one of precision_options(), by default float64 or float32 for float32 images.
+            'float32' halves memory and bandwidth, results agree with float64 to within 1e-6 relative
+        """
         self.image: numpy.ndarray = image
 
         self.moving_stdev = moving_stdev
         if len(self.image.shape) == 3:
             self.moving_stdev = rgb_moving_stdev
 
-        # dictionary used to cache image versions
-        self.dev_dict: dict[tuple[int, int, int], numpy.ndarray] = {}
+        # dictionary used to cache image versions, kept in order of last use
+        self.dev_dict: OrderedDict[tuple[int, int, int, str], numpy.ndarray] = OrderedDict()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # reads still planned for each result, results are dropped after their last planned read
+        self.uses: dict[tuple[int, int, int, str], int] = {}
+        self.dtype = precision_dtype(precision)
+        # running sums of the image, one per axis, shared by every window size
+        self.prefix_dict: dict[int, PrefixSumStdev] = {}
+        # summed-area tables for the box2d kernel, built on first use
+        self.summed_area: SummedAreaStdev or None = None
 
-    def __call__(self, window: int, min_count: int = 1, axis: int = -1):
-        method_id = window, min_count, axis
+        self.disk_cache = disk_cache
+        self._image_hash: str or None = None  # hashed on the first disk cache lookup
+
+    def __call__(self, window: int, min_count: int = 1, axis: int = -1, kernel: str = 'line'):
+        method_id = window, min_count, axis, kernel
         if method_id in self.dev_dict:
-            return self.dev_dict[method_id]
-        self.dev_dict[method_id] = moving_stdev(self.image, window, min_count, axis)
-        return self.dev_dict[method_id]
+            data = self.dev_dict[method_id]
+            self.dev_dict.move_to_end(method_id)
+        else:
+            data = self._lookup(method_id)
+            self._store(method_id, data)
+        if method_id in self.uses:
+            self.uses[method_id] -= 1
+            if self.uses[method_id] <= 0:
+                del self.uses[method_id]
+                self.release(*method_id)
+                if not self._planned(kernel, axis):  # the last planned read of the table it came from
+                    self.release_table(kernel, axis)
+        return data
+
+    def expect(self, window: int, uses: int, min_count: int = 1, axis: int = -1, kernel: str = 'line'):
+        """ plan [uses] more reads of a result, it is dropped after the last of them """
+        method_id = window, min_count, axis, kernel
+        self.uses[method_id] = self.uses.get(method_id, 0) + uses
+
+    def combine(self, windows: list[int or tuple[int, int]], method: str = 'sum',
+                kernel: str = 'line') -> numpy.ndarray:
+        """
+        Combine the results of several window sizes, each result is added to the output as soon as it is read,
+        so results whose last planned read this is, see expect(), are dropped before the next one is computed
+        """
+        combiner = Combiner(method, len(windows), window_output_shape(self.image.shape, windows))
+        for window in windows:
+            combiner.add(self(window, kernel=kernel))
+        return combiner.result()
+
+    def _lookup(self, method_id: tuple[int, int, int, str]) -> numpy.ndarray:
+        if self.disk_cache is None:
+            return self._compute(*method_id)
+        if self._image_hash is None:
+            self._image_hash = self.disk_cache.hash_array(self.image)
+        key = self.disk_cache.key(self._image_hash, 'stdev', method_id, str(self.dtype))
+        data = self.disk_cache.get(key)
+        if data is None:
+            data = self._compute(*method_id)
+            self.disk_cache.put(key, data)
+        return data
+
+    @Profile.stage('move_std', lambda self, window, min_count, axis, kernel: f'{kernel} {window}')
+    def _compute(self, window: int, min_count: int, axis: int, kernel: str) -> numpy.ndarray:
+        if kernel == 'box2d':
+            if self.summed_area is None:
+                self.summed_area = SummedAreaStdev(self.image, self.dtype)
+                self.nbytes += self.summed_area.nbytes
+            return self.summed_area(window)
+        if axis not in self.prefix_dict:
+            self.prefix_dict[axis] = PrefixSumStdev(self.image, axis, self.dtype)
+            self.nbytes += self.prefix_dict[axis].nbytes
+        return self.prefix_dict[axis](window, min_count)
+
+    def _store(self, method_id: tuple[int, int, int, str], data: numpy.ndarray):
+        self.dev_dict[method_id] = data
+        self.nbytes += data.nbytes
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes:
+            candidates = [key for key in self.dev_dict if key != method_id]
+            unplanned = [key for key in candidates if key not in self.uses]
+            tables = self._tables()
+            unplanned_tables = [table for table in tables if not self._planned(*table)]
+            if unplanned:
+                self.release(*unplanned[0])
+            elif unplanned_tables:
+                self.release_table(*unplanned_tables[0])
+            elif candidates:
+                self.release(*candidates[0])
+            elif tables:
+                self.release_table(*tables[0])
+            else:
+                break
+
+    def _tables(self) -> list[tuple[str, int]]:
+        """ (kernel, axis) of the running sum tables held """
+        tables = [('line', axis) for axis in self.prefix_dict]
+        return tables + [('box2d', -1)] if self.summed_area is not None else tables
+
+    def _planned(self, kernel: str, axis: int) -> bool:
+        """ whether reads planned through expect() still need the table of kernel and axis """
+        return any(k == kernel and (kernel == 'box2d' or a == axis) for _, _, a, k in self.uses)
+
+    def release_table(self, kernel: str = 'line', axis: int = -1):
+        """ drop the running sum table of a kernel, it is built again if a result needs it later """
+        if kernel == 'box2d':
+            table, self.summed_area = self.summed_area, None
+        else:
+            table = self.prefix_dict.pop(axis, None)
+        if table is not None:
+            self.nbytes -= table.nbytes
+
+    def holds(self, window: int, min_count: int = 1, axis: int = -1, kernel: str = 'line') -> bool:
+        """ whether a result is cached in memory """
+        return (window, min_count, axis, kernel) in self.dev_dict
+
+    def store(self, data: numpy.ndarray, window: int, min_count: int = 1, axis: int = -1, kernel: str = 'line'):
+        """ keep a result computed elsewhere, e.g. in row bands by apply_banded, as if it had been computed here """
+        method_id = window, min_count, axis, kernel
+        if method_id not in self.dev_dict:
+            self._store(method_id, data)
+
+    def release(self, window: int, min_count: int = 1, axis: int = -1, kernel: str = 'line'):
+        """ drop a cached result once nothing else will ask for it """
+        data = self.dev_dict.pop((window, min_count, axis, kernel), None)
+        if data is not None:
+            self.nbytes -= data.nbytes
 
 
+class PrefixSumStdev:
+    """
+    Running sums of x and x**2 along one axis of an array, built once and then used to produce the moving
+    standard deviation for any window size in O(1) per pixel.
+    Output matches moving_stdev(array, window, min_count, axis), including its cropping, exactly for integer images.
+    Float images are summed about the mean of each line, so an offset doesn't swamp the variance, and agree with
+    moving_stdev to within float rounding
+    """
+
+    @Profile.stage('prefix_sums', lambda self, array, axis=-1, dtype=None: 'line')
+    def __init__(self, array: numpy.ndarray, axis: int = -1, dtype=None):
+        """
+        :param array: 2d or 3d image array, 3d arrays are handled per channel in a single pass
+        :param axis: same meaning as the axis argument of moving_stdev
+        :param dtype: output dtype, by default float32 for float32 input and float64 otherwise, as bottleneck does
+        """
+        self.axis = -axis % 2  # moving_stdev passes -axis on to bottleneck, as a spatial axis
+        self.length = array.shape[self.axis]
+        self.shape = array.shape
+        self.out_dtype = dtype or (numpy.float32 if array.dtype == numpy.float32 else numpy.float64)
+
+        # integer images are summed exactly in int64, anything else in float64 about the mean of each line
+        values = _sum_values(array, self.axis)
+        self.sum_x = self._prefix(values)
+        numpy.multiply(values, values, out=values)
+        self.sum_x2 = self._prefix(values)
+
+    @property
+    def nbytes(self) -> int:
+        return self.sum_x.nbytes + self.sum_x2.nbytes
+
+    def _prefix(self, values: numpy.ndarray) -> numpy.ndarray:
+        """ cumulative sum along self.axis with a leading zero, so window sums are prefix[j + w] - prefix[j] """
+        shape = list(values.shape)
+        shape[self.axis] += 1
+        prefix = numpy.zeros(shape, dtype=values.dtype)
+        numpy.cumsum(values, axis=self.axis, out=prefix[self._along(1, None)])
+        return prefix
+
+    def _along(self, start: int or None, stop: int or None) -> tuple:
+        """ index tuple slicing self.axis only """
+        index = [slice(None)] * len(self.shape)
+        index[self.axis] = slice(start, stop)
+        return tuple(index)
+
+    def __call__(self, window: int, min_count: int = 1) -> numpy.ndarray:
+        if self.axis == 1 and window <= self.length:
+            return self._full_windows(window)
+        return self._partial_windows(window, min_count)
+
+    def _full_windows(self, window: int) -> numpy.ndarray:
+        """
+        Fast path for the default axis, the column crop of moving_stdev removes every partial window so each
+        output pixel is the stdev of exactly [window] values.
+        Rows are handled in blocks small enough for the temporaries to stay in cache
+        """
+        rows = self.shape[0] - window + 1
+        out = numpy.empty((rows, self.length - window + 1) + self.shape[2:], dtype=self.out_dtype)
+        step = _block_rows(out, self.sum_x.itemsize)
+        s = numpy.empty((step,) + out.shape[1:], dtype=self.sum_x.dtype)
+        q = numpy.empty_like(s)
+        for start in range(0, rows, step):
+            stop = min(start + step, rows)
+            n = stop - start
+            numpy.subtract(self.sum_x[start:stop, window:], self.sum_x[start:stop, :-window], out=s[:n])
+            numpy.subtract(self.sum_x2[start:stop, window:], self.sum_x2[start:stop, :-window], out=q[:n])
+            # var = (w * sum(x**2) - sum(x)**2) / w**2, exact up to the final division for integer images
+            numpy.multiply(q[:n], window, out=q[:n])
+            numpy.multiply(s[:n], s[:n], out=s[:n])
+            numpy.subtract(q[:n], s[:n], out=q[:n])
+            stdev_from_sums(q[:n], window * window, self.out_dtype, out=out[start:stop])
+        return out
+
+    def _partial_windows(self, window: int, min_count: int) -> numpy.ndarray:
+        """
+        General path, windows near the start of the axis hold fewer than [window] values,
+        as with bottleneck positions holding fewer than min_count values are NaN
+        """
+        n = self.length
+        s = self.sum_x[self._along(1, None)].copy()
+        q = self.sum_x2[self._along(1, None)].copy()
+        if window < n:
+            s[self._along(window, None)] -= self.sum_x[self._along(1, n - window + 1)]
+            q[self._along(window, None)] -= self.sum_x2[self._along(1, n - window + 1)]
+
+        count_shape = [1] * len(self.shape)
+        count_shape[self.axis] = n
+        count = numpy.minimum(numpy.arange(1, n + 1), window).reshape(count_shape)
+        numpy.multiply(q, count, out=q)
+        numpy.multiply(s, s, out=s)
+        numpy.subtract(q, s, out=q)
+        out = stdev_from_sums(q, count * count, self.out_dtype)
+        if min_count > 1:
+            out[numpy.broadcast_to(count < min_count, out.shape)] = numpy.nan
+        return out[:-window + 1, window - 1:]
+
+
+class SummedAreaStdev:
+    """
+    Summed-area tables of x and x**2, built once and then used to produce the standard deviation over a true
+    2d box window of any size at the same cost per pixel.
+    Output is cropped to the valid region, (h - rows + 1, w - cols + 1), matching moving_stdev for square windows.
+    Float images are summed about the mean of each channel
+    """
+
+    @Profile.stage('prefix_sums', lambda self, array, dtype=None: 'box2d')
+    def __init__(self, array: numpy.ndarray, dtype=None):
+        """
+        :param array: 2d or 3d image array, 3d arrays are handled per channel in a single pass
+        :param dtype: output dtype, by default float32 for float32 input and float64 otherwise
+        """
+        self.shape = array.shape
+        self.out_dtype = dtype or (numpy.float32 if array.dtype == numpy.float32 else numpy.float64)
+
+        values = _sum_values(array, (0, 1))
+        self.sum_x = self._table(values)
+        numpy.multiply(values, values, out=values)
+        self.sum_x2 = self._table(values)
+
+    @property
+    def nbytes(self) -> int:
+        return self.sum_x.nbytes + self.sum_x2.nbytes
+
+    @staticmethod
+    def _table(values: numpy.ndarray) -> numpy.ndarray:
+        """ summed-area table with a leading row and column of zeros """
+        table = numpy.zeros((values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:], dtype=values.dtype)
+        numpy.cumsum(values, axis=0, out=table[1:, 1:])
+        numpy.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+    @staticmethod
+    def _box_sum(table: numpy.ndarray, rows: int, cols: int, start: int, stop: int, out: numpy.ndarray):
+        """ sums of the boxes whose top row lies in [start, stop), written into out """
+        numpy.subtract(table[start + rows:stop + rows, cols:], table[start:stop, cols:], out=out)
+        out -= table[start + rows:stop + rows, :-cols]
+        out += table[start:stop, :-cols]
+
+    def __call__(self, window: int or tuple[int, int]) -> numpy.ndarray:
+        """
+        :param window: int for an N*N box or (rows, cols) for an N*M box
+        """
+        rows, cols = (window, window) if isinstance(window, int) else window
+        count = rows * cols
+        height = self.shape[0] - rows + 1
+        out = numpy.empty((height, self.shape[1] - cols + 1) + self.shape[2:], dtype=self.out_dtype)
+        step = _block_rows(out, self.sum_x.itemsize)
+        s = numpy.empty((step,) + out.shape[1:], dtype=self.sum_x.dtype)
+        q = numpy.empty_like(s)
+        for start in range(0, height, step):
+            stop = min(start + step, height)
+            n = stop - start
+            self._box_sum(self.sum_x, rows, cols, start, stop, s[:n])
+            self._box_sum(self.sum_x2, rows, cols, start, stop, q[:n])
+            numpy.multiply(q[:n], count, out=q[:n])
+            numpy.multiply(s[:n], s[:n], out=s[:n])
+            numpy.subtract(q[:n], s[:n], out=q[:n])
+            stdev_from_sums(q[:n], count * count, self.out_dtype, out=out[start:stop])
+        return out
+
+
+def _sum_values(array: numpy.ndarray, axis: int or tuple[int, int]) -> numpy.ndarray:
+    """
+    Copy of an image to build running sums from, int64 for integer images. Float images are float64 less their mean
+    along axis, the standard deviation is unchanged and sums of x**2 no longer lose the variance to the offset
+    """
+    if numpy.issubdtype(array.dtype, numpy.integer):
+        return array.astype(numpy.int64)
+    values = array.astype(numpy.float64)
+    mean = values.mean(axis=axis, keepdims=True)
+    numpy.nan_to_num(mean, copy=False, nan=0, posinf=0, neginf=0)  # lines holding NaN or inf are left as they are
+    values -= mean
+    return values
+
+
+def _block_rows(out: numpy.ndarray, itemsize: int, block_bytes: int = 2 ** 19) -> int:
+    """ number of output rows per block so each sum temporary stays around block_bytes """
+    row_bytes = max(out[:1].size * itemsize, 1)
+    return max(min(block_bytes // row_bytes, out.shape[0]), 1)
+
+
+def stdev_from_sums(numerator: numpy.ndarray, denominator, out_dtype, out: numpy.ndarray = None) -> numpy.ndarray:
+    """
+    Turn n * sum(x**2) - sum(x)**2 into a standard deviation by dividing by n**2,
+    clipping the small negative values float rounding can produce. The division and root are done in out_dtype
+    :param out: optional array of out_dtype to write the result into
+    """
+    out = numpy.divide(numerator, denominator, dtype=out_dtype, out=out)
+    numpy.maximum(out, 0, out=out)
+    numpy.sqrt(out, out=out)
+    return out
+
+
+@Profile.stage('apply', lambda function, *args, **kwargs: getattr(function, '__name__', type(function).__name__))
 def apply(function: Callable, array: numpy.ndarray, *args, **kwargs):
     """
-    Apply a fuinction to an RGB image, uses cv2 split and merge, everything except function and array is
-    passed to the function as an argument
+    Apply a fuinction to an RGB image, everything except function and array is passed to the function as an argument.
+    Functions that handle (h, w, c) arrays themselves, such as moving_stdev, get the whole array in one call,
+    anything else is applied to each channel in turn and written into a single (h, w, c) output
     :param function: function to apply over each colour of the array
     :param array: image array
     :param kwargs: cl_args for the function
     :return:
     """
-    if len(array.shape) == 3:
-        return cv2.merge([function(a, *args, **kwargs) for a in cv2.split(array)])
-    return function(array, *args, **kwargs)
+    if len(array.shape) != 3 or function in channel_vectorized:
+        return function(array, *args, **kwargs)
+    out = None
+    for channel in range(array.shape[2]):
+        result = function(array[..., channel], *args, **kwargs)
+        if out is None:
+            out = numpy.empty(result.shape + (array.shape[2],), dtype=result.dtype)
+        out[..., channel] = result
+    return out
 
 
+@Profile.stage('move_std', lambda array, window, *args, **kwargs: f'bottleneck {window}')
 def moving_stdev(array: numpy.ndarray, window: int, min_count: int = 1, axis: int = -1) -> numpy.ndarray:
     """
     Quickly apply a moving standard deviation calc over an array
-    :param array: input array to apply over
+    :param array: input array to apply over, 2d or (h, w, c), every channel is handled in the same call
     :param window: number of elements to apply the stdev method to must be > 1
     :param min_count:
-    :param axis:
+    :param axis: spatial axis of each channel, as for a 2d array
     :return:
     """
+    if numpy.issubdtype(array.dtype, numpy.integer):
+        # bottleneck's integer loops are ~10x slower than its float64 ones, results agree to within 1e-5
+        array = array.astype(numpy.float64)
     return bottleneck.move_std(array,
                                window=window,
                                min_count=min_count,
-                               axis=-axis,
+                               axis=-axis % 2,
                                )[:-window + 1, window - 1:]
 
 
+def box_stdev(array: numpy.ndarray, window: int or tuple[int, int]) -> numpy.ndarray:
+    """
+    Standard deviation over a 2d box window, cost does not depend on the window size
+    :param array: input array to apply over, 2d or 3d
+    :param window: int for an N*N box or (rows, cols) for an N*M box
+    :return:
+    """
+    return SummedAreaStdev(array)(window)
+
+
 def rgb_moving_stdev(array: numpy.ndarray, window: int, min_count: int = 1, axis: int = -1) -> numpy.ndarray:
     """
     apply moving stdev over an rgb array
     """
-    return cv2.merge([moving_stdev(a, window, min_count, axis) for a in cv2.split(array)])
+    return moving_stdev(array, window, min_count, axis)
 
 
+# functions taking (h, w, c) arrays directly, apply() does not split these per channel
+channel_vectorized = {moving_stdev, rgb_moving_stdev, box_stdev}
+
+
+def window_halo(windows: list[int or tuple[int, int]]) -> tuple[int, int]:
+    """
+    Rows and columns lost from the edges of an image by the largest of the given windows
+    :param windows: window sizes, int or (rows, cols)
+    :return: (rows, cols)
+    """
+    sizes = [(w, w) if isinstance(w, int) else w for w in windows]
+    return max(r for r, _ in sizes) - 1, max(c for _, c in sizes) - 1
+
+
+def _tile_starts(size: int, halo: int, tile: int) -> list[int]:
+    """ start of each tile along an axis, the last tile runs to the end of the axis """
+    starts = [0]
+    while starts[-1] + tile + halo < size:
+        starts.append(starts[-1] + tile)
+    return starts
+
+
+def apply_tiled(function: Callable, array: numpy.ndarray, halo: int or tuple[int, int],
+                tile: int or tuple[int, int] = 2048,
+                allocate: Callable = numpy.empty) -> numpy.ndarray or dict[str, numpy.ndarray]:
+    """
+    Apply a function over an image as overlapping tiles and stitch the results together, only one tile of
+    intermediate results exists at a time. Each input tile has [halo] extra rows and columns so the output matches
+    the untiled output, function must only lose rows and columns from the bottom right, as moving_stdev does.
+    :param function: function taking an image array, returning an array or a dict of arrays
+    :param array: image array
+    :param halo: rows and columns lost by function, int or (rows, cols), see window_halo
+    :param tile: output tile size in pixels per side, int or (rows, cols)
+    :param allocate: function(shape, dtype) used to create the output, e.g. IO.temporary_memmap
+    :return: output array, or dict of output arrays if function returns a dict
+    """
+    halo_r, halo_c = (halo, halo) if isinstance(halo, int) else halo
+    tile_r, tile_c = (tile, tile) if isinstance(tile, int) else tile
+    row_starts = _tile_starts(array.shape[0], halo_r, tile_r)
+    col_starts = _tile_starts(array.shape[1], halo_c, tile_c)
+    outputs = None
+    for r0 in row_starts:
+        r1 = array.shape[0] if r0 == row_starts[-1] else r0 + tile_r + halo_r
+        for c0 in col_starts:
+            c1 = array.shape[1] if c0 == col_starts[-1] else c0 + tile_c + halo_c
+            result = function(array[r0:r1, c0:c1])
+            result = result if isinstance(result, dict) else {None: result}
+            if outputs is None:  # output size can only be known from the first tile
+                outputs = {key: allocate((array.shape[0] - (r1 - r0 - res.shape[0]),
+                                          array.shape[1] - (c1 - c0 - res.shape[1])) + res.shape[2:], res.dtype)
+                           for key, res in result.items()}
+            for key, res in result.items():
+                # every tile but the last along each axis produces a [tile] sized block
+                res = res[:None if r0 == row_starts[-1] else tile_r, :None if c0 == col_starts[-1] else tile_c]
+                outputs[key][r0:r0 + res.shape[0], c0:c0 + res.shape[1]] = res
+    return outputs[None] if None in outputs else outputs
+
+
+def apply_rows(function: Callable, array: numpy.ndarray, halo: int or tuple[int, int],
+               rows: int = 256) -> numpy.ndarray or dict[str, numpy.ndarray]:
+    """
+    apply_tiled over blocks of full width rows, only the final outputs are allocated at full size,
+    everything function produces along the way exists for one block of [rows] output rows at a time
+    """
+    return apply_tiled(function, array, halo, (rows, array.shape[1]))
+
+
+def apply_stacked(function: Callable, images: list[numpy.ndarray]) -> list:
+    """
+    Apply a function to a batch of same shape images in a single call. The images are stacked along their rows,
+    (N, H, W, C) viewed as (N * H, W, C), and the output is split back into one result per image. Every output row
+    kept for an image only reads rows of that image, so each result matches applying function to the image alone,
+    under the same condition as apply_tiled: function must only lose rows and columns from the bottom right.
+    :param function: function taking an image array, returning an array or a dict of arrays
+    :param images: images of identical shape and dtype
+    :return: output array, or dict of output arrays, for each image
+    """
+    height = images[0].shape[0]
+    stack = numpy.stack(images)
+    stack = stack.reshape((-1,) + stack.shape[2:])
+    result = function(stack)
+    result = result if isinstance(result, dict) else {None: result}
+    # rows lost by each output, the last [lost] rows of each image only exist as part of the stack
+    lost = {key: stack.shape[0] - res.shape[0] for key, res in result.items()}
+    del stack
+    results = []
+    for i in range(len(images)):
+        outputs = {key: res[i * height: (i + 1) * height - lost[key]] for key, res in result.items()}
+        results.append(outputs[None] if None in outputs else outputs)
+    return results
+
+
+_band_pools: dict[int, ProcessPoolExecutor] = {}  # worker pools kept for reuse between images
+_input_key = ('input',)  # key of the input block, can't collide with output names
+
+
+def _shared_array(shape: tuple, dtype) -> tuple[shared_memory.SharedMemory, numpy.ndarray]:
+    """ allocate an array in shared memory, the array must be deleted before the block is closed """
+    block = shared_memory.SharedMemory(create=True, size=max(int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize, 1))
+    return block, numpy.ndarray(shape, dtype, buffer=block.buf)
+
+
+def _band_worker(function: Callable, source: tuple[str, tuple, str], r0: int, r1: int or None, halo: int,
+                 targets: dict[str, tuple[str, tuple, str]]):
+    """
+    process pool entry point, applies function to input rows r0 - r1 + halo and writes output rows r0 - r1
+    source and targets are (shared memory name, shape, dtype)
+    """
+    blocks = [shared_memory.SharedMemory(source[0])]
+    array = numpy.ndarray(source[1], source[2], buffer=blocks[0].buf)
+    result = function(array[r0:None if r1 is None else r1 + halo])
+    result = result if isinstance(result, dict) else {None: result}
+    for key, (name, shape, dtype) in targets.items():
+        blocks.append(shared_memory.SharedMemory(name))
+        out = numpy.ndarray(shape, dtype, buffer=blocks[-1].buf)
+        res = result[key][:None if r1 is None else r1 - r0]
+        out[r0:r0 + res.shape[0]] = res
+        del out
+    del array, result
+    for block in blocks:
+        block.close()
+
+
+@Profile.stage('banded', lambda function, array, halo, bands: f'{bands} bands')
+def apply_banded(function: Callable, array: numpy.ndarray, halo: int or tuple[int, int], bands: int
+                 ) -> numpy.ndarray or dict[str, numpy.ndarray]:
+    """
+    Apply a function over an image in parallel, the image is split into [bands] row bands overlapping by [halo]
+    rows and each band is processed by a worker process. Input and outputs are held in shared memory so bands are
+    never pickled. Output matches function(array), function must be picklable and follow the rules of apply_tiled.
+    :param function: function taking an image array, returning an array or a dict of arrays
+    :param array: image array
+    :param halo: rows and columns lost by function, int or (rows, cols), see window_halo
+    :param bands: number of bands and worker processes, 1 to run function directly
+    :return: output array, or dict of output arrays if function returns a dict
+    """
+    halo_r, halo_c = (halo, halo) if isinstance(halo, int) else halo
+    bands = min(bands, (array.shape[0] - halo_r) // (halo_r + 1))  # keep bands taller than the halo
+    # daemonic processes, e.g. multiprocessing.Pool workers, can't start processes of their own. ProcessPoolExecutor
+    # workers, as used by PresetMethods -m, can
+    if bands <= 1 or array.shape[1] <= halo_c or multiprocessing.current_process().daemon:
+        return function(array)
+
+    # a small probe gives the dtype and size lost from each output
+    with Profile.excluded():  # stages of the probe would be reported as if they were the work done in the bands
+        probe = function(array[:halo_r + 2, :halo_c + 2])
+    probe = probe if isinstance(probe, dict) else {None: probe}
+    blocks, shared, targets = [], {}, {}
+    try:
+        source_block, shared[_input_key] = _shared_array(array.shape, array.dtype)
+        blocks.append(source_block)
+        shared[_input_key][:] = array
+        for key, res in probe.items():
+            shape = (array.shape[0] - (halo_r + 2 - res.shape[0]), array.shape[1] - (halo_c + 2 - res.shape[1]))
+            block, shared[key] = _shared_array(shape + res.shape[2:], res.dtype)
+            blocks.append(block)
+            targets[key] = block.name, shared[key].shape, res.dtype.str
+
+        if bands not in _band_pools:
+            _band_pools[bands] = ProcessPoolExecutor(bands)
+        bounds = numpy.linspace(0, array.shape[0] - halo_r, bands + 1).astype(int).tolist()
+        bounds[-1] = None  # the last band runs to the end of the image
+        jobs = [_band_pools[bands].submit(_band_worker, function, (source_block.name, array.shape, array.dtype.str),
+                                          r0, r1, halo_r, targets) for r0, r1 in zip(bounds[:-1], bounds[1:])]
+        for job in jobs:
+            job.result()
+        # copy out of shared memory so the blocks can be released
+        outputs = {key: shared[key].copy() for key in targets}
+    finally:
+        shared.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return outputs[None] if None in outputs else outputs
+
+
+def precision_options() -> list[str]:
+    """ names accepted by the precision arguments """
+    return ['float64', 'float32']
+
+
+def precision_dtype(precision: str or None = None):
+    """
+    :param precision: one of precision_options(), or None to let the stdev engines follow the input dtype
+    :return: numpy dtype used to compute and store stdev results
+    """
+    if precision is None:
+        return None
+    if precision not in precision_options():
+        raise ValueError(f"precision argument invalid: {precision}")
+    return getattr(numpy, precision)
+
+
+def kernel_options() -> list[str]:
+    """ names accepted by the kernel arguments, 'line' is the original 1*N moving_stdev """
+    return ['line', 'box2d']
+
+
+def window_output_shape(shape: tuple, windows: list[int or tuple[int, int]]) -> tuple:
+    """
+    Shape of the combined stdev results of [windows] over an image of [shape],
+    both kernels crop [window] - 1 rows and columns and combining crops to the smallest result
+    """
+    rows = max(window if isinstance(window, int) else window[0] for window in windows)
+    cols = max(window if isinstance(window, int) else window[1] for window in windows)
+    return (shape[0] - rows + 1, shape[1] - cols + 1) + tuple(shape[2:])
+
+
+def _centre_crop(array: numpy.ndarray, shape: tuple) -> numpy.ndarray:
+    """ crop the first two axes of an array to [shape], removing the same amount from each side where possible """
+    if array.shape[:2] == tuple(shape[:2]):
+        return array
+    dx, dy = (array.shape[0] - shape[0]) // 2, (array.shape[1] - shape[1]) // 2
+    return array[dx: dx + shape[0], dy: dy + shape[1]]
+
+
+@Profile.stage('resize')
 def resize_list_of_arrays(array_list: list[numpy.ndarray]) -> list[numpy.ndarray]:
     """ resize all arrays given  to the size of the smallest array
     will attempt to remove the same amount from each side of the array
@@ -70,15 +633,7 @@ def resize_list_of_arrays(array_list: list[numpy.ndarray]) -> list[numpy.ndarray
     """
     min_x = min([arr.shape[0] for arr in array_list])  # find minimum width
     min_y = min([arr.shape[1] for arr in array_list])  # find minimum height
-    out_lst = []
-    for arr in array_list:
-        a_x, a_y = arr.shape[0], arr.shape[1]
-        if min_x == a_x and min_y and a_y:  # fix for if an array is of correct size..
-            out_lst.append(arr)
-            continue
-        dx1, dx2 = math.floor((a_x - min_x) / 2), math.ceil((a_x - min_x) / 2)
-        dy1, dy2 = math.floor((a_y - min_y) / 2), math.ceil((a_y - min_y) / 2)
-        out_lst.append(arr[dx1: -dx2, dy1: -dy2])
+    out_lst = [_centre_crop(arr, (min_x, min_y)) for arr in array_list]
     first_item = out_lst[0]
     comepleted_list = [arr for arr in out_lst if arr.shape == first_item.shape]
     if len(array_list) != len(comepleted_list):
@@ -99,26 +654,95 @@ def combine_method_options(as_str=False) -> str or list[str]:
     return part
 
 
+class Combiner:
+    """
+    Weighted reduction behind combine_array_list, arrays are added one at a time and accumulated into a single
+    output buffer, so a caller can add window results as they are produced and drop each one straight after.
+    Arrays are cropped about their centre to [shape] as resize_list_of_arrays does and are never modified.
+    'sum' weights every array by 1, 'avg' divides that sum by [count],
+    'dist' adds array i as array / count * i + 1, so later arrays count for more.
+    Results are identical to summing the weighted arrays in order, '-dist' adds arrays in their given order rather
+    than reversed so can differ from that in the last bit
+    """
+
+    def __init__(self, method: str, count: int, shape: tuple or None = None):
+        """
+        :param method: one of combine_method_options(), prepend '-' to reverse the order of the weights
+        :param count: number of arrays that will be added
+        :param shape: output shape, by default the shape of the first array added
+        """
+        self.reverse = method[0] == '-'
+        self.method = method[1:] if self.reverse else method
+        if self.method not in ('sum', 'avg', 'dist'):
+            raise ValueError(f"method argument invalid: {self.method}")
+        self.count = count
+        self.shape = shape
+        self.added = 0
+        self.out: numpy.ndarray or None = None
+        self._scratch: numpy.ndarray or None = None  # row block buffer for weighted adds
+
+    def weight(self, index: int) -> int:
+        """ dist weight of the array added at [index] before division by count, 1 for the other methods """
+        if self.method != 'dist':
+            return 1
+        return self.count - 1 - index if self.reverse else index
+
+    @Profile.stage('combine', lambda self, array: self.method)
+    def add(self, array: numpy.ndarray):
+        array = numpy.asarray(array)
+        if self.shape is None:
+            self.shape = array.shape
+        array = _centre_crop(array, self.shape) if array.ndim >= 2 else array
+        weight = self.weight(self.added)
+        self.added += 1
+        if self.out is None:
+            self.out = numpy.zeros(array.shape, dtype=numpy.result_type(array.dtype, 1.0))
+        if self.method != 'dist':
+            numpy.add(self.out, array, out=self.out)
+        elif self.out.ndim < 2:
+            self.out += array / self.count * weight + 1
+        else:
+            # weighted add in row blocks so the product never needs a full size temporary
+            if self._scratch is None:
+                step = _block_rows(self.out, self.out.itemsize)
+                self._scratch = numpy.empty((step,) + self.out.shape[1:], dtype=self.out.dtype)
+            step = self._scratch.shape[0]
+            for start in range(0, self.out.shape[0], step):
+                stop = min(start + step, self.out.shape[0])
+                block = self._scratch[:stop - start]
+                # same order of operations as array / count * weight + 1 in the unfused version
+                numpy.divide(array[start:stop], self.count, out=block)
+                numpy.multiply(block, weight, out=block)
+                numpy.add(block, 1, out=block)
+                numpy.add(self.out[start:stop], block, out=self.out[start:stop])
+
+    def result(self) -> numpy.ndarray:
+        if self.added != self.count:
+            raise ValueError(f"expected {self.count} arrays, {self.added} were added")
+        self._scratch = None
+        if self.method == 'avg':
+            self.out /= self.count
+        return self.out
+
+
 def combine_array_list(array_list: list[numpy.ndarray], method: str = "sum") -> numpy.ndarray:
     """
+    Arrays of different sizes are cropped to the smallest, see resize_list_of_arrays
     :param array_list:
     :param method: ['sum','avg','dist'] prepend '-' to reverse list before application
     :return:
+
+    dist will output a combination closer to the final inputs given,
+    this can be called on a list of integers or floats for testing purposes:
+
+    >>> [float(combine_array_list([5, 10, 25], m)) for m in combine_method_options()]
+    [40.0, 13.333333333333334, 23.0, 9.666666666666668]
     """
-    if method[0] == '-':
-        method = method[1:]
-        array_list = array_list[::-1]
-
-    if method == 'sum':
-        return sum(array_list)
-    if method == 'avg':
-        return sum(array_list) / len(array_list)
-    if method == 'dist':
-        """ dist outputs: array_list = [5,10,25] len(array_list = 3  
-            ( 5*1/3*1 + 10*1/3*2 + 25*1/3*3 ) / 3 = 11.111 
-            dist will output a combination closer to the final inputs given
-            this can be called on a list of integers or floats for testing purposes
-        """
-        return sum([arr * 1 / len(array_list) * i + 1 for i, arr in enumerate(array_list)])
-    else:
-        raise ValueError(f"method argument invalid: {method}")
+    shape = None
+    if numpy.ndim(array_list[0]) >= 2:
+        shape = (min(arr.shape[0] for arr in array_list), min(arr.shape[1] for arr in array_list))
+        shape += array_list[0].shape[2:]
+    combiner = Combiner(method, len(array_list), shape)
+    for arr in array_list:
+        combiner.add(arr)
+    return combiner.result()
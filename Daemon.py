@@ -0,0 +1,266 @@
+import http.server
+import json
+import pathlib
+import threading
+import time
+from collections import deque
+
+import Cache
+import Client
+import Contrast
+import ImageProcessingTools
+import PresetMethods
+
+# Long running process serving jobs over localhost http, numpy, cv2 and bottleneck are imported once and worker
+# threads, band pools and compiled preset plans stay warm between jobs.
+# POST /job with a json job runs it and replies once it is done, GET /status reports the queue, see Client.py
+job_kinds = ['single_pass', 'multi_pass', 'preset']
+
+
+class Job:
+    """
+    One file to process, jobs are json objects:
+    {'kind': 'single_pass', 'file': path, 'output': path, 'window': 5, 'kernel': 'line', 'rgb': true}
+    {'kind': 'multi_pass', 'file': path, 'output': path, 'window': [3, 5, 7], 'combine': 'dist'}
+    {'kind': 'preset', 'file': path, 'methods': ['cont_8', 'add_area']}, outputs go to file.parent / method name
+    """
+
+    def __init__(self, request: dict):
+        kind = request.get('kind')
+        if kind not in job_kinds:
+            raise ValueError(f"kind must be one of {', '.join(job_kinds)}, got {kind}")
+        self.file = pathlib.Path(request['file'])
+        if not self.file.is_file():
+            raise ValueError(f"file not found: {self.file}")
+        if kind == 'preset':
+            unknown = [name for name in request['methods'] if name not in PresetMethods.named_methods]
+            if unknown:
+                raise ValueError(f"unknown methods {unknown}, options: {', '.join(PresetMethods.named_methods)}")
+        else:
+            missing = [key for key in ('output', 'window') if key not in request]
+            if missing:
+                raise ValueError(f"{kind} jobs need {', '.join(missing)}")
+            if kind == 'multi_pass' and request.get('combine', 'sum') not in Contrast.combine_method_options():
+                raise ValueError(f"combine must be one of {Contrast.combine_method_options(True)}")
+        self.kind = kind
+        self.request = request
+        self.queued = time.perf_counter()
+        self.started: float or None = None
+        self.finished: float or None = None
+        self.batch = 1  # number of jobs it was run with
+        self.error: str or None = None
+        self.done = threading.Event()
+
+    def batch_key(self) -> str:
+        """ jobs with equal keys only differ in their files and can be run together """
+        return json.dumps({k: v for k, v in self.request.items() if k not in ('file', 'output')}, sort_keys=True)
+
+    def result(self) -> dict:
+        result = {'file': self.file.as_posix(), 'kind': self.kind, 'batch': self.batch,
+                  'queued_s': self.started - self.queued, 'run_s': self.finished - self.started}
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+
+class JobQueue:
+    """ first in first out, except that take() also removes queued jobs that can run with the first """
+
+    def __init__(self):
+        self.jobs: deque[Job] = deque()
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def put(self, job: Job):
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify()
+
+    def take(self, batch_size: int) -> list[Job]:
+        """ wait for a job, :return: it and up to batch_size - 1 later jobs with the same batch key """
+        with self.condition:
+            self.condition.wait_for(lambda: self.jobs)
+            batch = [self.jobs.popleft()]
+            key = batch[0].batch_key()
+            for job in list(self.jobs):
+                if len(batch) >= batch_size:
+                    break
+                if job.batch_key() == key:
+                    self.jobs.remove(job)
+                    batch.append(job)
+            return batch
+
+
+class Daemon:
+    def __init__(self, workers: int = 1, batch_size: int = 16, bands: int = 1,
+                 cache: Cache.DiskCache or None = None):
+        """
+        :param workers: batches processed at once
+        :param batch_size: maximum jobs run together
+        :param bands: number of row bands of each image processed in parallel, 1 to disable
+        :param cache: optional cache of outputs and intermediate results
+        """
+        self.batch_size = batch_size
+        self.bands = bands
+        self.cache = cache
+        self.queue = JobQueue()
+        self.plans: dict[tuple, PresetMethods.PresetPlan] = {}  # compiled once per set of methods
+        self.lock = threading.Lock()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.wait_total = 0.0
+        self.started = time.time()
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, request: dict) -> Job:
+        """ queue a job, raises ValueError or KeyError for invalid jobs """
+        job = Job(request)
+        self.queue.put(job)
+        return job
+
+    def status(self) -> dict:
+        with self.lock:
+            finished = self.completed + self.failed
+            return {'queue_depth': len(self.queue), 'running': self.running, 'completed': self.completed,
+                    'failed': self.failed, 'uptime_s': time.time() - self.started,
+                    'mean_latency_s': self.latency_total / finished if finished else None,
+                    'max_latency_s': self.latency_max if finished else None,
+                    'mean_queued_s': self.wait_total / finished if finished else None}
+
+    def _plan(self, methods: list[str], precision: str or None) -> PresetMethods.PresetPlan:
+        key = tuple(methods), precision
+        if key not in self.plans:
+            self.plans[key] = PresetMethods.PresetPlan({name: PresetMethods.named_methods[name] for name in methods},
+                                                       precision)
+        return self.plans[key]
+
+    def _work(self):
+        while True:
+            batch = self.queue.take(self.batch_size)
+            start = time.perf_counter()
+            with self.lock:
+                self.running += len(batch)
+            for job in batch:
+                job.started = start
+                job.batch = len(batch)
+            try:
+                self._run(batch)
+            except Exception as e:
+                for job in batch:
+                    job.error = job.error or f'{type(e).__name__}: {e}'
+            finished = time.perf_counter()
+            with self.lock:
+                self.running -= len(batch)
+                for job in batch:
+                    job.finished = finished
+                    self.failed += job.error is not None
+                    self.completed += job.error is None
+                    self.latency_total += finished - job.queued
+                    self.latency_max = max(self.latency_max, finished - job.queued)
+                    self.wait_total += start - job.queued
+            for job in batch:
+                job.done.set()
+
+    def _run(self, batch: list[Job]):
+        request = batch[0].request
+        if batch[0].kind == 'preset':
+            plan = self._plan(request['methods'], request.get('precision'))
+            failures = PresetMethods.batch_plan_on_files([job.file for job in batch], plan, self.batch_size,
+                                                         self.bands, request.get('rows', 0), self.cache)
+            for job in batch:
+                job.error = failures.get(job.file)
+            return
+        for job in batch:  # pass jobs share the warm process, each file is still processed on its own
+            request = job.request
+            kwargs = dict(kernel=request.get('kernel', 'line'), bands=self.bands, cache=self.cache,
+                          precision=request.get('precision'))
+            try:
+                if job.kind == 'single_pass':
+                    ImageProcessingTools.single_pass(job.file.as_posix(), request['output'], request.get('rgb', True),
+                                                     request['window'], **kwargs)
+                else:
+                    ImageProcessingTools.multi_pass(job.file.as_posix(), request['output'], request.get('rgb', True),
+                                                    request['window'], request.get('combine', 'sum'), **kwargs)
+            except Exception as e:
+                job.error = f'{type(e).__name__}: {e}'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server: '_Server'
+
+    def _reply(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.server.daemon.status())
+        else:
+            self._reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/job':
+            self._reply(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.server.daemon.submit(request)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+            return
+        job.done.wait()  # each request has its own thread, see ThreadingHTTPServer
+        self._reply(500 if job.error else 200, job.result())
+
+    def log_message(self, format, *args):
+        pass  # one line per request drowns out the job output
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Client.submit_all opens many connections at once, the default backlog is 5
+
+    def __init__(self, address: tuple[str, int], daemon: Daemon):
+        super().__init__(address, _Handler)
+        self.daemon = daemon
+
+
+def serve(daemon: Daemon, address: tuple[str, int] = Client.default_address):
+    """ serve jobs until interrupted """
+    with _Server(address, daemon) as server:
+        print(f"Serving on http://{address[0]}:{address[1]}, POST /job, GET /status")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="serve jobs from a warm process, send jobs with Client.py")
+    parser.add_argument("-port", "--port", dest="port", type=int, default=Client.default_address[1])
+    parser.add_argument("-workers", "--workers", dest="workers", help="batches processed at once", type=int,
+                        default=1)
+    parser.add_argument("-bs", "--batch_size", dest="batch_size", help="maximum queued jobs run together", type=int,
+                        default=16)
+    parser.add_argument("-b", "--bands", dest="bands",
+                        help="split each image into this many row bands processed in parallel, 1 to disable",
+                        type=int, default=1)
+    parser.add_argument("-cache", "--cache", dest="cache", help="folder used to keep results between runs")
+    parser.add_argument("-cache_size", "--cache_size", dest="cache_size", help="cache size budget in GB",
+                        type=float, default=10)
+    args = parser.parse_args()
+
+    cache = Cache.DiskCache(args.cache, int(args.cache_size * 2 ** 30)) if args.cache else None
+    serve(Daemon(args.workers, args.batch_size, args.bands, cache), (Client.default_address[0], args.port))
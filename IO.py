@@ -1,9 +1,14 @@
+import os
 import pathlib
+import tempfile
+from collections.abc import Iterable
 from pathlib import Path
 
-from cv2 import cv2
+import cv2
 import numpy
 
+import Profile
+
 
 def get_list_of_files(directory: pathlib.Path) -> list[pathlib.Path]:
     """ Return a list of files below the given directory """
@@ -17,41 +22,244 @@ def get_list_of_files(directory: pathlib.Path) -> list[pathlib.Path]:
     return file_list
 
 
+def iter_files(directory: pathlib.Path, recursive: bool = True, skip_dirs: set[str] = frozenset()):
+    """
+    Lazily yield files below the given directory, work can start before the whole tree has been listed
+    :param directory: directory to walk
+    :param recursive: include files in sub folders
+    :param skip_dirs: names of sub folders to leave out, e.g. output folders being written to during the walk
+    """
+    assert directory.is_dir()
+    with os.scandir(directory) as entries:
+        sub_dirs = []
+        for entry in entries:
+            if entry.is_file():
+                yield pathlib.Path(entry.path)
+            elif recursive and entry.is_dir() and entry.name not in skip_dirs:
+                sub_dirs.append(pathlib.Path(entry.path))
+    for sub_dir in sub_dirs:
+        yield from iter_files(sub_dir, recursive, skip_dirs)
+
+
 test_file_list: list[pathlib.Path] = get_list_of_files(pathlib.Path('TestFiles'))
 
 
+# raw containers hold arrays of any dtype as they are, without encoding or quantising, and load memory mapped, so
+# chained passes and presets hand data on without a decode, see load_image and export_image
+raw_extensions = {'.npy'}
+
+
+@Profile.stage('decode')
 def load_image(file: pathlib.Path, rgb=True) -> numpy.ndarray:
-    """ get image from disk using cv2 """
+    """
+    get image from disk using cv2, raw containers are memory mapped read only instead of being decoded
+    :return: None if the file could not be read
+    """
+    if file.suffix.lower() in raw_extensions:
+        if not file.is_file():
+            return None
+        data = numpy.load(file, mmap_mode='r')
+        if not rgb and data.ndim == 3:  # same weights as cv2.COLOR_BGR2GRAY
+            return data[..., :3] @ numpy.array([0.114, 0.587, 0.299], numpy.float32 if data.dtype.itemsize < 8
+                                               else numpy.float64)
+        return data
     if rgb:
         return cv2.imread(file.as_posix(), cv2.IMREAD_COLOR)
     return cv2.imread(file.as_posix(), cv2.IMREAD_GRAYSCALE)
 
 
-def export_image(url: pathlib.Path, data: numpy.ndarray):
+@Profile.stage('quantise')
+def quantise(data: numpy.ndarray, normalise: bool = False, dtype=numpy.uint8,
+             block_bytes: int = 2 ** 22) -> numpy.ndarray:
     """
-    Export image to disk using cv2 imwrite
-    :param url: url to place the file, including extension "here/this.jpg"
+    Convert an array to integer pixel values in row blocks, so a large float result never has a full size temporary.
+    By default values are rounded to the nearest integer and clipped to the range of dtype, NaN becomes 0, which is
+    what cv2.imwrite does with unsupported depths
+    :param normalise: stretch the range of data to the full range of dtype first
+    :param dtype: numpy.uint8 or numpy.uint16
+    """
+    if data.dtype == dtype and not normalise:
+        return data
+    top = numpy.iinfo(dtype).max
+    out = numpy.empty(data.shape, dtype)
+    low, scale = 0, 1
+    if normalise:
+        low, high = float(numpy.nanmin(data)), float(numpy.nanmax(data))
+        scale = top / (high - low) if high > low else 0
+    row_bytes = max(data[:1].size * 8, 1)
+    step = max(block_bytes // row_bytes, 1)
+    for start in range(0, data.shape[0], step):
+        block = numpy.asarray(data[start:start + step], dtype=numpy.float64)
+        if normalise:
+            block = (block - low) * scale
+        numpy.rint(block, out=block)
+        numpy.clip(block, 0, top, out=block)
+        numpy.nan_to_num(block, copy=False, nan=0)
+        out[start:start + step] = block
+    return out
+
+
+# dtypes cv2 encodes as they are in each format, other dtypes and formats are quantised to 8 bits, see export_image.
+# exr needs a cv2 built with OpenEXR, pip builds also need OPENCV_IO_ENABLE_OPENEXR=1 set before cv2 is imported
+_native_dtypes = {'.png': {numpy.dtype(numpy.uint16)},
+                  '.tif': {numpy.dtype(numpy.uint16), numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)},
+                  '.tiff': {numpy.dtype(numpy.uint16), numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)},
+                  '.exr': {numpy.dtype(numpy.float32)}}
+
+
+@Profile.stage('encode')
+def export_image(url: pathlib.Path, data: numpy.ndarray, normalise: bool = False):
+    """
+    Export image to disk using cv2 imwrite, or as a raw container for the extensions in raw_extensions.
+    Raw containers keep the array as it is, so do formats able to hold its dtype: uint16 png and tiff, float32 and
+    float64 tiff and float32 exr, other float data is written to exr as float32. Anything else is quantised to 8 bits
+    first, see quantise
+    :param url: url to place the file, including extension "here/this.jpg" or "here/this.npy"
     :param data: numpy array containing image data
+    :param normalise: stretch the values of data over the full 8 bit range, not used for raw output
     """
     url.parent.mkdir(parents=True, exist_ok=True)  # make sure theres somewhere to save the image
-    cv2.imwrite(url.as_posix(), data)
+    suffix = url.suffix.lower()
+    if suffix in raw_extensions:
+        numpy.save(url, data)
+        return
+    if not normalise and data.dtype in _native_dtypes.get(suffix, ()):
+        cv2.imwrite(url.as_posix(), data)
+        return
+    if not normalise and suffix == '.exr' and data.dtype.kind == 'f':
+        cv2.imwrite(url.as_posix(), data.astype(numpy.float32))
+        return
+    cv2.imwrite(url.as_posix(), quantise(data, normalise))
+
+
+def _jpeg_size(f) -> tuple[int, int] or None:
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':  # skip to the next marker
+            byte = f.read(1)
+        while byte == b'\xff':  # markers may be padded with fill bytes
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # markers without a segment
+            continue
+        length = int.from_bytes(f.read(2), 'big')
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):  # start of frame
+            header = f.read(5)
+            return int.from_bytes(header[1:3], 'big'), int.from_bytes(header[3:5], 'big')
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def image_size(file: pathlib.Path) -> tuple[int, int] or None:
+    """
+    Read the (height, width) of an image from its header without decoding it, for png, jpeg, bmp, gif, webp and raw
+    containers
+    :return: None for other formats and unreadable files
+    """
+    if file.suffix.lower() in raw_extensions:
+        try:
+            return numpy.load(file, mmap_mode='r').shape[:2]
+        except (OSError, ValueError):
+            return None
+    try:
+        with open(file, 'rb') as f:
+            header = f.read(30)
+            if header.startswith(b'\x89PNG\r\n\x1a\n'):
+                return int.from_bytes(header[20:24], 'big'), int.from_bytes(header[16:20], 'big')
+            if header.startswith(b'\xff\xd8'):
+                return _jpeg_size(f)
+            if header.startswith(b'BM'):
+                return abs(int.from_bytes(header[22:26], 'little', signed=True)), int.from_bytes(header[18:22],
+                                                                                                 'little')
+            if header[:6] in (b'GIF87a', b'GIF89a'):
+                return int.from_bytes(header[8:10], 'little'), int.from_bytes(header[6:8], 'little')
+            if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+                if header[12:16] == b'VP8 ':
+                    return int.from_bytes(header[28:30], 'little') & 0x3fff, int.from_bytes(header[26:28],
+                                                                                            'little') & 0x3fff
+                if header[12:16] == b'VP8L':
+                    bits = int.from_bytes(header[21:25], 'little')
+                    return (bits >> 14 & 0x3fff) + 1, (bits & 0x3fff) + 1
+                if header[12:16] == b'VP8X':
+                    return int.from_bytes(header[27:30], 'little') + 1, int.from_bytes(header[24:27], 'little') + 1
+    except OSError:
+        pass
+    return None
+
+
+def temporary_memmap(shape: tuple, dtype) -> numpy.memmap:
+    """ disk backed array for outputs larger than RAM, the file is removed once the array is released """
+    return numpy.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
 
 
-def load_video(file: pathlib.Path) -> numpy.ndarray:
+def _open_video(file: pathlib.Path) -> tuple[cv2.VideoCapture, int, int, int]:
+    """ :return: capture, frame count, frame width, frame height """
+    capture = cv2.VideoCapture(file.__str__())
+    if not capture.isOpened():
+        raise FileNotFoundError(f"Unable to open video: {file}")
+    return (capture,
+            int(capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+            int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+
+def iter_video(file: pathlib.Path, block_size: int = 0):
+    """
+    Yield the frames of a video one at a time, or as blocks, without holding the whole clip in memory
+    :param file: video file
+    :param block_size: 0 to yield single uint8 frames (h, w, 3), otherwise yield uint8 blocks of up to
+        [block_size] frames (n, h, w, 3), the last block may be shorter
+    """
+    capture, frame_count, frame_width, frame_height = _open_video(file)
     try:
-        capture = cv2.VideoCapture(file.__str__())
-        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        block = numpy.empty((block_size, frame_height, frame_width, 3), dtype=numpy.uint8) if block_size else None
+        filled = 0
+        while True:
+            with Profile.section('decode', 'video'):
+                return_val, frame = capture.read() if block is None else capture.read(block[filled])
+            if not return_val:
+                break
+            if block is None:
+                yield frame
+                continue
+            if frame is not None and not numpy.shares_memory(frame, block[filled]):
+                # cv2 allocates a new frame when it can't decode into the view, e.g. a different size or depth
+                if frame.shape != block.shape[1:]:
+                    raise ValueError(f"Frame {frame.shape} does not match the video size {block.shape[1:]}: {file}")
+                block[filled] = frame
+            filled += 1
+            if filled == block_size:
+                yield block
+                # a new block each time, the consumer may keep the previous one
+                block = numpy.empty_like(block)
+                filled = 0
+        if block is not None and filled:
+            yield block[:filled]
+    finally:
+        capture.release()
 
-        buffer = numpy.empty((frame_count, frame_height, frame_width, 3))
+
+def load_video(file: pathlib.Path, memmap: bool = False) -> numpy.ndarray:
+    """
+    Load a whole video as a uint8 array (frames, h, w, 3)
+    :param file: video file
+    :param memmap: hold the frames in a disk backed array, for random access to clips larger than RAM
+    """
+    try:
+        capture, frame_count, frame_width, frame_height = _open_video(file)
+        capture.release()
+        shape = (frame_count, frame_height, frame_width, 3)
+        buffer = temporary_memmap(shape, numpy.uint8) if memmap else numpy.empty(shape, dtype=numpy.uint8)
 
         frame = 0
-        return_val = True
-        while frame < frame_count and return_val:
-            return_val, buffer[frame] = capture.read()
+        for frame_data in iter_video(file):
+            if frame == frame_count:  # the frame count in the header is only an estimate
+                break
+            buffer[frame] = frame_data
             frame += 1
-        capture.release()
+        buffer = buffer[:frame]
         print(f'Image: {buffer.shape}')
         return buffer
     except FileNotFoundError as fnf:
@@ -59,26 +267,43 @@ def load_video(file: pathlib.Path) -> numpy.ndarray:
         exit(1)
 
 
-def export_video(url: pathlib.Path, data: numpy.ndarray, fps=30):
+def export_video(url: pathlib.Path, data: numpy.ndarray or Iterable[numpy.ndarray], fps=30):
+    """
+    Export a video to disk as MJPG .avi
+    :param url: output file
+    :param data: array of frames (frames, h, w, 3), or any iterable of frames (h, w, 3) or blocks of frames
+        (n, h, w, 3) such as iter_video, frames are converted to uint8 one at a time
+    :param fps: output fps
+    """
     url.parent.mkdir(parents=True, exist_ok=True)
     if url.suffix != '.avi':
         print(f"Fixing suffix without error: from {url.suffix}")
         url = url.with_suffix('.avi')
 
-    try:
-        data = data.astype('uint8')
-        out = cv2.VideoWriter(filename=url.__str__(),
-                              fourcc=cv2.VideoWriter_fourcc(*'MJPG'),
-                              fps=fps,
-                              frameSize=(data.shape[2], data.shape[1]))
-        for frame in data:
-            out.write(frame)
+    def frames():
+        for item in data:
+            if item.ndim == 4:
+                yield from item
+            else:
+                yield item
 
-        out.release()
+    out = None
+    try:
+        for frame in frames():
+            if out is None:  # frame size is only known once the first frame arrives
+                out = cv2.VideoWriter(filename=url.__str__(),
+                                      fourcc=cv2.VideoWriter_fourcc(*'MJPG'),
+                                      fps=fps,
+                                      frameSize=(frame.shape[1], frame.shape[0]))
+            with Profile.section('encode', 'video'):
+                out.write(frame.astype('uint8', copy=False))
 
     except FileNotFoundError as fnf:
         print(f'FileNotFoundError: \n\t\t{url}  \n{fnf}')
         exit(1)
+    finally:
+        if out is not None:
+            out.release()
 
 
 def assign_path(path_string: str, assert_file: bool = False, assert_extension: str or None = None):
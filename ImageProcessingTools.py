@@ -1,7 +1,16 @@
 import argparse
+import pathlib
+from collections.abc import Callable
+from concurrent.futures import Future, wait
+from functools import partial
 
+import numpy
+
+import Cache
 import Contrast
 import IO
+import Preview
+import Profile
 
 
 def list_from_input(in_var: str) -> list[int] or int:
@@ -18,7 +27,86 @@ def list_from_input(in_var: str) -> list[int] or int:
     return in_var
 
 
-def single_pass(file_in: str, file_out: str, rgb: bool, window: int, return_image=False):
+def stdev_pass(data, window: int or list[int], combine_method: str = 'sum', kernel: str = 'line',
+               disk_cache: Cache.DiskCache or None = None, precision: str or None = None):
+    """
+    Single or multi pass standard deviation over an image array
+    :param data: image array
+    :param window: window size, or list of window sizes to combine
+    :param combine_method: method used to combine the passes when given a list of window sizes
+    :param kernel: 'line' for the 1*N moving stdev, 'box2d' for an N*N box
+    :param disk_cache: optional cache of the stdev result of each window
+    :param precision: dtype used for stdev results, see Contrast.precision_options
+    :return:
+    """
+    image = Contrast.ImageCache(data, disk_cache, precision=precision)
+    if isinstance(window, int):
+        return image(window, kernel=kernel)
+    for w in window:  # each window result is dropped once it has been added to the combination
+        image.expect(w, 1, kernel=kernel)
+    return image.combine(window, combine_method, kernel)
+
+
+def window_results(data, windows: list[int], kernel: str = 'line', precision: str or None = None) -> dict:
+    """ :return: {window: stdev result} of each window over an image array, see Session.stdev_pass """
+    image = Contrast.ImageCache(data, precision=precision)
+    windows = list(dict.fromkeys(windows))
+    for w in windows:  # the running sums are dropped with the last result
+        image.expect(w, 1, kernel=kernel)
+    return {w: image(w, kernel=kernel) for w in windows}
+
+
+def split_stdev_pass(data, window: int or list[int], combine_method: str = 'sum', kernel: str = 'line',
+                     tile: int = 0, bands: int = 1, disk_cache: Cache.DiskCache or None = None,
+                     precision: str or None = None):
+    """
+    stdev_pass over a split image, output is identical to the unsplit result.
+    When tile is set the image is processed in tiles of [tile] output pixels per side and the result is stitched
+    into a disk backed array, otherwise with bands > 1 row bands of the image are processed in parallel.
+    disk_cache is only used when the image is not split, parts of an image are not worth caching.
+    """
+    if not tile and bands <= 1:
+        return stdev_pass(data, window, combine_method, kernel, disk_cache, precision)
+    function = partial(stdev_pass, window=window, combine_method=combine_method, kernel=kernel, precision=precision)
+    halo = Contrast.window_halo(window if isinstance(window, list) else [window])
+    if tile:
+        return Contrast.apply_tiled(function, data, halo, tile, IO.temporary_memmap)
+    return Contrast.apply_banded(function, data, halo, bands)
+
+
+def read_image(file: pathlib.Path, rgb: bool) -> numpy.ndarray:
+    """ IO.load_image raising ValueError for unreadable input instead of returning None """
+    data = IO.load_image(file, rgb=rgb)
+    if data is None:
+        raise ValueError(f"Unreadable input, could not read image: {file}")
+    return data
+
+
+def load_pass(file_in: str, rgb: bool, window: int or list[int], combine_method: str = 'sum', kernel: str = 'line',
+              tile: int = 0, bands: int = 1, cache: Cache.DiskCache or None = None, precision: str or None = None):
+    """
+    Load a file and run split_stdev_pass over it, with a cache the output is looked up by the content of the file
+    and the parameters before the file is decoded
+    :param cache: optional cache of outputs and of the stdev result of each window
+    :param precision: dtype used for stdev results, see Contrast.precision_options
+    """
+    file = IO.assign_path(file_in, True)
+    if cache is None:
+        return split_stdev_pass(read_image(file, rgb), window, combine_method, kernel, tile, bands,
+                                precision=precision)
+    key = cache.key(cache.hash_file(file), 'pass', rgb, window, combine_method if isinstance(window, list) else None,
+                    kernel, precision)
+    data = cache.get(key)
+    if data is None:
+        data = split_stdev_pass(read_image(file, rgb), window, combine_method, kernel, tile, bands, cache,
+                                precision)
+        cache.put(key, data)
+    return data
+
+
+def single_pass(file_in: str, file_out: str, rgb: bool, window: int, return_image=False, kernel: str = 'line',
+                tile: int = 0, bands: int = 1, cache: Cache.DiskCache or None = None, precision: str or None = None,
+                normalise: bool = False):
     """
 
     :param file_in: target input file as string
@@ -26,16 +114,23 @@ def single_pass(file_in: str, file_out: str, rgb: bool, window: int, return_imag
     :param rgb: True to load image as rgb, False for greyscale
     :param window: window size for standard deviation calculation
     :param return_image: ignore file_out and return the image instead
+    :param kernel: 'line' for the 1*N moving stdev, 'box2d' for an N*N box
+    :param tile: process in tiles of this many pixels per side, 0 to process the whole image at once
+    :param bands: number of row bands processed in parallel, 1 to disable
+    :param cache: optional cache of outputs and intermediate results kept between runs
+    :param precision: dtype used for stdev results, see Contrast.precision_options
+    :param normalise: stretch the output over the full range of the image format, see IO.quantise
     :return:
     """
-    data = IO.load_image(IO.assign_path(file_in, True), rgb=rgb)
-    data = Contrast.apply(Contrast.moving_stdev, data, window=window)
+    data = load_pass(file_in, rgb, window, kernel=kernel, tile=tile, bands=bands, cache=cache, precision=precision)
     if return_image: return data
-    IO.export_image(IO.assign_path(file_out, True), data)
+    IO.export_image(IO.assign_path(file_out, True), data, normalise)
     print(f"Operation Complete\n{'-' * 20}")
 
 
-def multi_pass(file_in: str, file_out: str, rgb: bool, window: list[int], combine_method: str, return_image=False):
+def multi_pass(file_in: str, file_out: str, rgb: bool, window: list[int], combine_method: str, return_image=False,
+               kernel: str = 'line', tile: int = 0, bands: int = 1, cache: Cache.DiskCache or None = None,
+               precision: str or None = None, normalise: bool = False):
     """
 
     :param file_in: target input file as string
@@ -44,14 +139,17 @@ def multi_pass(file_in: str, file_out: str, rgb: bool, window: list[int], combin
     :param window: window size for standard deviation calculation
     :param combine_method: method used to combine the passes
     :param return_image: ignore file_out and return the image instead
+    :param kernel: 'line' for the 1*N moving stdev, 'box2d' for an N*N box
+    :param tile: process in tiles of this many pixels per side, 0 to process the whole image at once
+    :param bands: number of row bands processed in parallel, 1 to disable
+    :param cache: optional cache of outputs and intermediate results kept between runs
+    :param precision: dtype used for stdev results, see Contrast.precision_options
+    :param normalise: stretch the output over the full range of the image format, see IO.quantise
     :return:
     """
-    data = IO.load_image(IO.assign_path(file_in, True), rgb=rgb)
-    data = [Contrast.apply(Contrast.moving_stdev, data, window=w) for w in window]
-    data = Contrast.resize_list_of_arrays(data)
-    data = Contrast.combine_array_list(data, combine_method)
+    data = load_pass(file_in, rgb, window, combine_method, kernel, tile, bands, cache, precision)
     if return_image: return data
-    IO.export_image(IO.assign_path(file_out, True), data)
+    IO.export_image(IO.assign_path(file_out, True), data, normalise)
     print(f"Operation Complete\n{'-' * 20}")
 
 
@@ -61,49 +159,165 @@ def commandline_mode(cl_args: argparse.Namespace):
     :return:
     """
     window = list_from_input(cl_args.window)
+    cache = Cache.DiskCache(cl_args.cache, int(cl_args.cache_size * 2 ** 30)) if cl_args.cache else None
     print(f"{'-' * 20}\nBeginning operation")
     if isinstance(window, int):
         single_pass(file_in=cl_args.filename,
                     file_out=cl_args.output,
                     rgb=cl_args.rgb,
-                    window=window)
+                    window=window,
+                    kernel=cl_args.kernel,
+                    tile=cl_args.tile,
+                    bands=cl_args.bands,
+                    cache=cache,
+                    precision=cl_args.precision,
+                    normalise=cl_args.normalise)
     else:
         multi_pass(file_in=cl_args.filename,
                    file_out=cl_args.output,
                    rgb=cl_args.rgb,
                    window=window,
-                   combine_method=cl_args.combine_options)
+                   combine_method=cl_args.combine_options,
+                   kernel=cl_args.kernel,
+                   tile=cl_args.tile,
+                   bands=cl_args.bands,
+                   cache=cache,
+                   precision=cl_args.precision,
+                   normalise=cl_args.normalise)
+
+
+class Session:
+    """
+    Decoded image and window results kept between the passes of an interactive session, windows repeated across
+    lines and runs are computed once so later passes only cost their combine. Changing the file, rgb or the file
+    on disk loads the image again.
+    Windows not kept yet are computed together in row bands in parallel, then kept like any other result.
+    A second, small image serves previews, see Preview, full resolution passes run on the render queue so a preview
+    can be shown while earlier renders finish.
+    """
+
+    def __init__(self, max_bytes: int or None = None, precision: str or None = None,
+                 preview_pixels: int = Preview.default_max_pixels, bands: int = 1):
+        """
+        :param max_bytes: memory budget of kept window results, least recently used results are dropped first
+        :param precision: dtype used for stdev results, see Contrast.precision_options
+        :param preview_pixels: most pixels of the preview image
+        :param bands: number of row bands new windows are computed in, in parallel, 1 to disable
+        """
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self.bands = bands
+        self.key: tuple or None = None
+        self.image: Contrast.ImageCache or None = None
+        self.preview_pixels = preview_pixels
+        self.preview_key: tuple or None = None
+        self.preview_image: Contrast.ImageCache or None = None
+        self.preview_level = 0
+
+    def load(self, file_in: str, rgb: bool) -> Contrast.ImageCache:
+        """ :return: ImageCache of the file, decoded only if it isn't the image of the last pass """
+        file = IO.assign_path(file_in, True)
+        key = file.resolve(), rgb, file.stat().st_mtime_ns
+        if key != self.key:
+            self.image = Contrast.ImageCache(read_image(file, rgb), max_bytes=self.max_bytes, precision=self.precision)
+            self.key = key
+        return self.image
+
+    def stdev_pass(self, file_in: str, rgb: bool, window: int or list[int], combine_method: str = 'sum',
+                   kernel: str = 'line'):
+        """ stdev_pass over the file, results are read from arrays kept by the session and must not be modified """
+        image = self.compute(file_in, rgb, window if isinstance(window, list) else [window], kernel)
+        if isinstance(window, int):
+            return image(window, kernel=kernel)
+        return image.combine(window, combine_method, kernel)
+
+    def compute(self, file_in: str, rgb: bool, windows: list[int], kernel: str = 'line') -> Contrast.ImageCache:
+        """
+        Compute the windows the session doesn't hold yet together in row bands, see Contrast.apply_banded
+        :return: ImageCache of the file, see load
+        """
+        image = self.load(file_in, rgb)
+        missing = [w for w in dict.fromkeys(windows) if not image.holds(w, kernel=kernel)]
+        if self.bands > 1 and missing:
+            function = partial(window_results, windows=missing, kernel=kernel, precision=self.precision)
+            results = Contrast.apply_banded(function, image.image, Contrast.window_halo(missing), self.bands)
+            for w in missing:
+                image.store(results[w], w, kernel=kernel)
+        return image
+
+    def preview(self, file_in: str, rgb: bool, window: int or list[int], combine_method: str = 'sum',
+                kernel: str = 'line'):
+        """ stdev_pass at the pyramid level of the file fitting within preview_pixels, with windows scaled to match """
+        file = IO.assign_path(file_in, True)
+        key = file.resolve(), rgb, file.stat().st_mtime_ns
+        if key != self.preview_key:
+            data, self.preview_level = Preview.load_level(file, rgb, self.preview_pixels)
+            if data is None:
+                raise ValueError(f"Could not read image: {file}")
+            self.preview_image = Contrast.ImageCache(data, precision=self.precision)
+            self.preview_key = key
+        window = Preview.scale_windows(window, self.preview_level)
+        if isinstance(window, int):
+            return self.preview_image(window, kernel=kernel)
+        return self.preview_image.combine(window, combine_method, kernel)
+
+
+def queue_export(file_out: str, function: Callable) -> Future:
+    """ export the result of function() to file_out on the render queue, see Preview.queue_render """
+    def render():
+        IO.export_image(IO.assign_path(file_out, True), function())
+        print(f"Operation Complete: {file_out}\n{'-' * 20}")
+    return Preview.queue_render(render)
+
+
+def layered_pass(pass_function: Callable, window_list: list[str], final_combination_method: str):
+    """
+    Combine one pass for each window line of interactive_complex_mode
+    :param pass_function: pass_function(window, combine_method) -> image array, e.g. Session.stdev_pass
+    :param window_list: lines in window syntax, e.g. '5' or '3,5,7 dist'
+    :param final_combination_method: method used to combine the passes of the lines
+    """
+    image_list = []
+    for window in window_list:
+        window_sizes = list_from_input(window)
+        combine_opt = 'sum' if isinstance(window_sizes, int) else get_first_valid_combination_type(window)
+        image_list.append(pass_function(window_sizes, combine_opt))
+    image_list = Contrast.resize_list_of_arrays(image_list)
+    return Contrast.combine_array_list(image_list, final_combination_method)
 
 
-def interactive_mode():
+def interactive_mode(session: Session or None = None):
     """
     interactive mode for user input
+    :param session: keeps the image and window results between runs, a new session by default
     :return:
     """
+    session = session or Session()
+    renders = []
     filename = input("Target input file: ")
     while True:
         output = input("Target output file: ")
         window = list_from_input(input("Window size, int or list[int]: "))
-        sub_args = input("Additional arguments, --no-rgb: ")
+        sub_args = input("Additional arguments, --no-rgb, --box2d, --preview: ")
         rgb = "--no-rgb" not in sub_args
+        kernel = 'box2d' if "--box2d" in sub_args else 'line'
 
         print(f"{'-' * 20}\nBeginning operation")
-        if isinstance(window, int):
-            single_pass(file_in=filename,
-                        file_out=output,
-                        rgb=rgb,
-                        window=window)
-        else:
+        combine_options = 'sum'
+        if not isinstance(window, int):
             combine_options = input(
                 "method used to combine multi-pass images: 'sum', 'avg', 'dist' - prepend '-' to invert list: ")
-            inverse = False
-            multi_pass(file_in=filename,
-                       file_out=output,
-                       rgb=rgb,
-                       window=window,
-                       combine_method=combine_options)
+        full_pass = partial(session.stdev_pass, filename, rgb, window, combine_options, kernel)
+        if "--preview" in sub_args:
+            # the full resolution render runs in the background while the next parameters are previewed
+            Preview.show(IO.quantise(session.preview(filename, rgb, window, combine_options, kernel)))
+            if input("render at full resolution? y/n: ") == "y":
+                renders.append(queue_export(output, full_pass))
+        else:
+            queue_export(output, full_pass).result()
         if input("run again on same file? y/n: ") != "y":
             break
+    wait(renders)
 
 
 def get_first_valid_combination_type(string: str) -> str:
@@ -114,16 +328,19 @@ def get_first_valid_combination_type(string: str) -> str:
     return [c for c in Contrast.combine_method_options() if c in string][0]
 
 
-def interactive_complex_mode():
+def interactive_complex_mode(session: Session or None = None):
     """
     Interactive complex mode for user input
     This mode gives additional methods but is less user friendly.
+    :param session: keeps the image and window results between lines, a new session by default
     :return:
     """
+    session = session or Session()
     filename = input("Target input file: ")
     output = input("Target output file: ")
-    sub_args = input("Additional arguments, --no-rgb: ")
+    sub_args = input("Additional arguments, --no-rgb, --box2d, --preview: ")
     rgb = "--no-rgb" not in sub_args
+    kernel = 'box2d' if "--box2d" in sub_args else 'line'
 
     window_list = []
     print(f"{'-' * 20}\nWindow syntax: [int] or [list[int] combine] e.g. '5' or '3,5,7 dist'")
@@ -136,30 +353,23 @@ def interactive_complex_mode():
             window_list.append(current)
 
     final_combination_method = get_first_valid_combination_type(input(f"Final combination method: "))
+    if "--preview" in sub_args:
+        Preview.show(IO.quantise(layered_pass(partial(session.preview, filename, rgb, kernel=kernel), window_list,
+                                              final_combination_method)))
+        if input("render at full resolution? y/n: ") != "y":
+            return
     print(f"{'-' * 20}\nBeginning operations")
-    image_list = []
-    for window in window_list:
-        try:
-            image_list.append(
-                single_pass(file_in=filename,
-                            file_out=output,
-                            rgb=rgb,
-                            window=int(window),
-                            return_image=True))
-
-        except ValueError:  # calls this if single_pass() fails due to int(window)
-            window_sizes = list_from_input(window)
-            combine_opt = get_first_valid_combination_type(window)
-            image_list.append(
-                multi_pass(file_in=filename,
-                           file_out=output,
-                           rgb=rgb,
-                           window=window_sizes,
-                           combine_method=combine_opt,
-                           return_image=True))
-    image_list = Contrast.resize_list_of_arrays(image_list)
-    image = Contrast.combine_array_list(image_list, final_combination_method)
-    IO.export_image(IO.assign_path(output), image)
+
+    def render():
+        # the image is decoded once and the windows of every line are computed once, together in row bands
+        windows = []
+        for line in window_list:
+            window_sizes = list_from_input(line)
+            windows += window_sizes if isinstance(window_sizes, list) else [window_sizes]
+        session.compute(filename, rgb, windows, kernel)
+        return layered_pass(partial(session.stdev_pass, filename, rgb, kernel=kernel), window_list,
+                            final_combination_method)
+    queue_export(output, render).result()
 
 
 if __name__ == '__main__':
@@ -184,16 +394,60 @@ if __name__ == '__main__':
                         help="method used to combine multi-pass images, prepend '-' to invert list",
                         choices=Contrast.combine_method_options(), default="sum")
 
+    # used in Contrast.ImageCache
+    parser.add_argument("-k", "--kernel", dest="kernel",
+                        help="stdev window shape, 'line' for 1*N strips, 'box2d' for N*N boxes",
+                        choices=Contrast.kernel_options(), default="line")
+
+    parser.add_argument("-t", "--tile", dest="tile",
+                        help="process large images in tiles of this many pixels per side, 0 to disable",
+                        type=int, default=0)
+
+    parser.add_argument("-b", "--bands", dest="bands",
+                        help="split the image into this many row bands processed in parallel, 1 to disable, "
+                             "worth it for large images, small images spend longer starting the workers",
+                        type=int, default=1)
+
+    parser.add_argument("-cache", "--cache", dest="cache",
+                        help="folder used to keep results between runs, unchanged inputs are not processed again")
+    parser.add_argument("-cache_size", "--cache_size", dest="cache_size", help="cache size budget in GB",
+                        type=float, default=10)
+
+    parser.add_argument("-p", "--precision", dest="precision",
+                        help="dtype used for stdev results, float32 halves memory use",
+                        choices=Contrast.precision_options(), default=None)
+
+    parser.add_argument("-mb", "--memory_budget", dest="memory_budget",
+                        help="GB of window results kept between passes of an interactive session, 0 for no limit",
+                        type=float, default=0)
+
     # additional options
     parser.add_argument("-rgb", "--rgb", dest="rgb", help="Use RGB image functions",
                         action=argparse.BooleanOptionalAction, default=True)
 
+    parser.add_argument("-normalise", "--normalise", dest="normalise",
+                        help="stretch the output over the full range of the image format, outputs to .npy keep the "
+                             "raw values either way",
+                        action=argparse.BooleanOptionalAction, default=False)
+
+    parser.add_argument("-profile", "--profile", dest="profile", nargs='?', const='',
+                        help="print the time and memory of each stage, optionally write a json trace to the given "
+                             "file, work in other processes (bands, multicore) is only timed as a whole, use -b 1 "
+                             "to see its stages")
+
     args = parser.parse_args()
     print(args)
+    if args.profile is not None:
+        Profile.enable()
 
     if args.interactive:
-        interactive_mode()
+        interactive_mode(Session(int(args.memory_budget * 2 ** 30) or None, args.precision, bands=args.bands))
     elif args.interactive_complex:
-        interactive_complex_mode()
+        interactive_complex_mode(Session(int(args.memory_budget * 2 ** 30) or None, args.precision, bands=args.bands))
     else:
         commandline_mode(args)
+
+    if args.profile is not None:
+        print(Profile.report())
+        if args.profile:
+            Profile.write_trace(args.profile)
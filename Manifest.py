@@ -0,0 +1,83 @@
+import json
+import os
+import pathlib
+
+import Cache
+
+
+class Manifest:
+    """
+    Record of the files in a folder that have been processed, so a rerun only touches new or changed inputs and a
+    killed run resumes where it stopped.
+    Each line of the manifest file is the json record of one input: its size, modification time and content hash,
+    and a key for each method applied to it. A line is appended and flushed to disk after every file, later lines
+    replace earlier ones for the same file, and the file is rewritten with one line per input when loaded.
+    Files whose size or modification time changed are hashed again, so touching a file doesn't reprocess it.
+    """
+
+    def __init__(self, path: pathlib.Path or str):
+        """
+        :param path: manifest file, created if missing, inputs are recorded relative to its folder
+        """
+        self.path = pathlib.Path(path)
+        self.root = self.path.parent.resolve()
+        self.records: dict[str, dict] = {}
+        if self.path.is_file():
+            for line in self.path.read_text().splitlines():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # last line of a run killed mid write
+                    continue
+                self.records[record['file']] = record
+            self.compact()
+
+    def __repr__(self):
+        return f"Manifest({self.path.as_posix()}, {len(self.records)} files)"
+
+    def _name(self, file: pathlib.Path) -> str:
+        file = file.resolve()
+        return file.relative_to(self.root).as_posix() if file.is_relative_to(self.root) else file.as_posix()
+
+    def compact(self):
+        """ rewrite the manifest with one line per input """
+        temporary = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        temporary.write_text(''.join(json.dumps(record) + '\n' for record in self.records.values()))
+        os.replace(temporary, self.path)
+
+    def _unchanged(self, file: pathlib.Path, record: dict) -> bool:
+        stat = file.stat()
+        if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if record['size'] != stat.st_size or record['hash'] != Cache.DiskCache.hash_file(file):
+            return False
+        record['mtime_ns'] = stat.st_mtime_ns  # touched but not changed, saved with the next record
+        return True
+
+    def pending(self, file: pathlib.Path, keys: dict[str, str], outputs: dict[str, pathlib.Path]) -> list[str]:
+        """
+        :param keys: {method name: key of the method definition}, see PresetMethods.method_keys
+        :param outputs: {method name: output file}
+        :return: names of the methods that still need to be applied to the file
+        """
+        record = self.records.get(self._name(file))
+        if record is None or not self._unchanged(file, record):
+            return list(keys)
+        if record.get('unreadable'):
+            return []
+        return [name for name, key in keys.items() if record['methods'].get(name) != key or not outputs[name].exists()]
+
+    def record(self, file: pathlib.Path, keys: dict[str, str], unreadable: bool = False):
+        """ note that the methods in keys have been applied to the file, or that the file could not be read """
+        name = self._name(file)
+        stat = file.stat()
+        record = self.records.get(name)
+        if record is None or not self._unchanged(file, record):
+            record = {'file': name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                      'hash': Cache.DiskCache.hash_file(file), 'methods': {}}
+        record['methods'].update(keys)
+        record['unreadable'] = unreadable
+        self.records[name] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
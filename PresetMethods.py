@@ -1,11 +1,24 @@
 import pathlib
-from collections.abc import Callable
+import time
+from collections.abc import Callable, Iterable
 from functools import partial
 
+import numpy
+
+import Cache
 import Contrast
 import IO
+import Manifest
+import Profile
+import WorkQueue
 
 use_multi_core_processing = False
+# bytes the multicore workers may use together, None for the memory available when the run starts
+multi_core_memory_budget: int or None = None
+# suffix of output files, e.g. '.npy' to hand results to a later stage as raw arrays, None to keep the input suffix
+output_suffix: str or None = None
+# stretch outputs over the full range of the image format, see IO.quantise
+normalise_output = False
 named_methods = {
     'cont_8': (
         ([7, 9, 11, 13, ], 'dist'), ([7, 9, 11, 13], '-dist'), ([5, 7, 9], 'avg'), ([3, 5, 7], 'avg'),
@@ -42,45 +55,599 @@ def apply_in_folder(folder: str, function: Callable, allow_sub_folders=False, **
 
     file_list = get_list_of_files(IO.assign_path(folder))
     if use_multi_core_processing:
-        function = partial(function, **kwargs)
-        quick_pool(function, file_list)
+        bytes_per_pixel = kwargs['plan'].bytes_per_pixel() if 'plan' in kwargs else default_bytes_per_pixel
+        schedule_files(partial(function, **kwargs), file_list, bytes_per_pixel, multi_core_memory_budget)
     else:
         for file in file_list:
             function(file, **kwargs)
 
 
-def apply_to_file(file: pathlib.Path, method: list, sub_folder_name: str):
+def output_file(file: pathlib.Path, name: str) -> pathlib.Path:
+    """ output of a named method for an input file, file.parent / method name / file name """
+    output = file.parent / name / file.parts[-1]
+    return output.with_suffix(output_suffix) if output_suffix else output
+
+
+def export_output(file: pathlib.Path, name: str, output_image):
+    IO.export_image(output_file(file, name), output_image, normalise_output)
+
+
+def apply_to_file(file: pathlib.Path, method: list, sub_folder_name: str, bands: int = 1):
+    """
+    Apply a named method to a file, each part of the method is either a window size or a tuple of
+    ([window sizes], combine method) with an optional third item naming the kernel, e.g. ([5, 9], 'avg', 'box2d')
+    :param bands: number of row bands processed in parallel, 1 to disable
+    """
+    apply_plan_to_file(file, PresetPlan({sub_folder_name: method}), bands=bands)
+
+
+def apply_plan_to_file(file: pathlib.Path, plan: 'PresetPlan', tile: int = 0, bands: int = 1,
+                       cache: Cache.DiskCache or None = None, rows: int = 0):
+    """
+    Load a file once and export the output of every method in the plan to file.parent / method name / file name
+    :param tile: process in tiles of this many pixels per side, 0 to process the whole image at once
+    :param bands: number of row bands processed in parallel, 1 to disable
+    :param cache: optional cache of outputs and intermediate results kept between runs, the file is only decoded
+        if an output is missing from the cache
+    :param rows: evaluate the plan in blocks of this many output rows, 0 to evaluate the whole image at once
+    :return: False if the file could not be read as an image
+    """
+    keys = {}
+    if cache is not None:
+        outputs, plan, keys = lookup_plan(file, plan, cache)
+        for name, output_image in outputs.items():
+            export_output(file, name, output_image)
+        if plan is None:
+            return True
     image = IO.load_image(file)
-    image = Contrast.ImageCache(image)
-    data_list = []
+    if image is None:
+        print(f"Skipping unreadable file: {file}")
+        return False
+    for name, output_image in plan.apply(image, tile, bands, cache, rows):
+        if name in keys:
+            cache.put(keys[name], output_image)
+        export_output(file, name, output_image)
+    return True
+
+
+def method_keys(plan: 'PresetPlan') -> dict[str, str]:
+    """ {method name: key of the compiled method and precision}, a key changes whenever its definition does """
+    return {name: Cache.DiskCache.key('preset', plan.methods[name], plan.precision) for name in plan.methods}
+
+
+def update_folder(folder: str, plan: 'PresetPlan', manifest: Manifest.Manifest, allow_sub_folders=False,
+                  settle: float = 0, tile: int = 0, bands: int = 1, rows: int = 0,
+                  cache: Cache.DiskCache or None = None) -> int:
+    """
+    Apply a plan to the files of a folder that are new or changed since they were recorded in the manifest, methods
+    added to the plan or changed since are applied to every file, outputs that have been deleted are made again.
+    Each file is recorded as soon as its outputs are written, so an interrupted run resumes from the next file.
+    :param settle: skip files modified in the last [settle] seconds, they may still be being written
+    :return: number of files processed
+    """
+    keys = method_keys(plan)
+    processed = 0
+    for file in IO.iter_files(IO.assign_path(folder), allow_sub_folders, set(plan.methods)):
+        if file.resolve() == manifest.path.resolve() or file.suffix == '.tmp':
+            continue
+        if settle and time.time() - file.stat().st_mtime < settle:
+            continue
+        missing = manifest.pending(file, keys, {name: output_file(file, name) for name in keys})
+        if not missing:
+            continue
+        readable = apply_plan_to_file(file, plan.subset(missing), tile, bands, cache, rows)
+        manifest.record(file, {name: keys[name] for name in missing} if readable else {}, not readable)
+        processed += 1
+    return processed
+
+
+def watch_folder(folder: str, plan: 'PresetPlan', manifest: Manifest.Manifest, allow_sub_folders=False,
+                 interval: float = 2, **kwargs):
+    """
+    Process files as they land in a folder until interrupted, the folder is checked every [interval] seconds and
+    files are picked up once they have not been modified for [interval] seconds, see update_folder
+    :param kwargs: passed on to update_folder
+    """
+    print(f"Watching {folder} every {interval}s, ctrl+c to stop")
+    try:
+        while True:
+            processed = update_folder(folder, plan, manifest, allow_sub_folders, settle=interval, **kwargs)
+            if processed:
+                print(f"Processed {processed} file(s)")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def enqueue_folder(folder: str, work_queue: WorkQueue.WorkQueue, plan: 'PresetPlan', allow_sub_folders=False) -> int:
+    """
+    Add the files of a folder to a shared work queue, files already queued keep their state
+    :return: number of files added
+    """
+    files = IO.iter_files(IO.assign_path(folder), allow_sub_folders, set(plan.methods))
+    return work_queue.add(file for file in files if not file.name.startswith(work_queue.path.name))
+
+
+def work_from_queue(queue_path: pathlib.Path or str, plan: 'PresetPlan', lease: float = 600, max_attempts: int = 3,
+                    tile: int = 0, bands: int = 1, rows: int = 0, cache: Cache.DiskCache or None = None) -> int:
+    """
+    Claim files from a shared work queue and apply a plan to them until the queue is done, any number of workers on
+    any number of machines can work from the same queue, see WorkQueue.WorkQueue.
+    A worker waits while other workers hold files, so files of a worker that died are picked up once its lease runs out
+    :return: number of files processed by this worker
+    """
+    work_queue = WorkQueue.WorkQueue(queue_path, lease, max_attempts)
+    worker = WorkQueue.worker_name()
+    processed = 0
+    try:
+        while True:
+            names = work_queue.claim(worker)
+            if not names:
+                counts = work_queue.counts()
+                if not counts.get('pending') and not counts.get('running'):
+                    return processed
+                time.sleep(min(lease / 3, 5))
+                continue
+            name = names[0]
+            try:
+                with WorkQueue.LeaseRenewal(work_queue, worker, names):
+                    readable = apply_plan_to_file(work_queue.file(name), plan, tile, bands, cache, rows)
+            except Exception as e:
+                print(f"Failed on {name}: {type(e).__name__}: {e}")
+                work_queue.fail(worker, name, f'{type(e).__name__}: {e}')
+                continue
+            if readable:
+                work_queue.complete(worker, name)
+                processed += 1
+            else:
+                work_queue.fail(worker, name, 'unreadable')
+    finally:
+        work_queue.close()
+
+
+def lookup_plan(file: pathlib.Path, plan: 'PresetPlan', cache: Cache.DiskCache
+                ) -> tuple[dict, 'PresetPlan' or None, dict[str, str]]:
+    """
+    Look up the outputs of a plan for a file by the content of the file
+    :return: ({method name: cached output}, plan of the methods missing from the cache or None, {method name: key})
+    """
+    file_hash = cache.hash_file(file)
+    keys = {name: cache.key(file_hash, 'preset', plan.methods[name], plan.precision) for name in plan.methods}
+    outputs = {name: cache.get(key) for name, key in keys.items()}
+    missing = [name for name, output_image in outputs.items() if output_image is None]
+    outputs = {name: output_image for name, output_image in outputs.items() if output_image is not None}
+    return outputs, plan.subset(missing) if missing else None, keys
+
+
+class PresetPlan:
+    """
+    Compiled set of named methods.
+    Every distinct window and every distinct (windows, combine, kernel) group is computed once per image and shared
+    between all methods using it, results are dropped as soon as the last method using them has read them.
+    """
+
+    def __init__(self, methods: dict[str, tuple], precision: str or None = None, max_bytes: int or None = None):
+        """
+        :param methods: {name: method} using the named_methods layout
+        :param precision: dtype used for stdev results, see Contrast.precision_options
+        :param max_bytes: memory budget for cached window results of each image, see Contrast.ImageCache
+        """
+        self.definitions = dict(methods)
+        self.precision = precision
+        self.max_bytes = max_bytes
+        # name -> (list of ('window' | 'group', node), final combine method)
+        self.methods: dict[str, tuple[list[tuple[str, tuple]], str]] = {}
+        # number of reads of each node over a full run of the plan
+        self.window_uses: dict[tuple[int, str], int] = {}
+        self.group_uses: dict[tuple[tuple[int, ...], str, str], int] = {}
+        self._bytes_per_pixel: float or None = None  # measured on first use
+
+        for name, method in methods.items():
+            parts = []
+            for parse in method[:-1]:
+                if isinstance(parse, tuple):
+                    node = tuple(parse[0]), parse[1], parse[2] if len(parse) > 2 else 'line'
+                    if node not in self.group_uses:
+                        self.group_uses[node] = 0
+                        for window in node[0]:
+                            self._add_window_use((window, node[2]))
+                    self.group_uses[node] += 1
+                    parts.append(('group', node))
+                elif isinstance(parse, int):
+                    node = parse, 'line'
+                    self._add_window_use(node)
+                    parts.append(('window', node))
+            self.methods[name] = parts, method[-1]
+
+    def _add_window_use(self, node: tuple[int, str]):
+        self.window_uses[node] = self.window_uses.get(node, 0) + 1
+
+    @property
+    def halo(self) -> tuple[int, int]:
+        """ rows and columns lost by the largest window of the plan """
+        return Contrast.window_halo([window for window, _ in self.window_uses])
+
+    def subset(self, names: list[str]) -> 'PresetPlan':
+        """ plan of some of the methods of this plan """
+        return PresetPlan({name: self.definitions[name] for name in names}, self.precision, self.max_bytes)
+
+    def image_cache(self, image, disk_cache: Cache.DiskCache or None = None) -> Contrast.ImageCache:
+        """ ImageCache using the precision and memory budget of the plan """
+        return Contrast.ImageCache(image, disk_cache, self.max_bytes, self.precision)
+
+    def apply(self, image, tile: int = 0, bands: int = 1, disk_cache: Cache.DiskCache or None = None,
+              rows: int = 0):
+        """
+        Evaluate every method of the plan against an image array
+        :param image: image array
+        :param tile: process in tiles of this many pixels per side with disk backed outputs, 0 to disable
+        :param bands: number of row bands processed in parallel when not using tiles, 1 to disable
+        :param disk_cache: optional cache of the stdev result of each window, unused when the image is split
+        :param rows: evaluate the whole plan in blocks of this many output rows when not using tiles, only the
+            final outputs are held at full size, 0 to disable. Combined with bands each band is evaluated in blocks
+        :return: iterable of (method name, output image)
+        """
+        if tile:
+            return Contrast.apply_tiled(self.outputs, image, self.halo, tile, IO.temporary_memmap).items()
+        function = partial(Contrast.apply_rows, self.outputs, halo=self.halo, rows=rows) if rows else self.outputs
+        if bands > 1:
+            return Contrast.apply_banded(function, image, self.halo, bands).items()
+        if rows:
+            return function(image).items()
+        return self.run(self.image_cache(image, disk_cache))
+
+    def apply_batch(self, images: list, bands: int = 1, rows: int = 0) -> list[dict]:
+        """
+        Evaluate every method of the plan against a batch of same shape images at once, see Contrast.apply_stacked.
+        Results match running each image through apply exactly for integer images
+        :param images: images of identical shape and dtype
+        :param bands: number of row bands of the batch processed in parallel, 1 to disable
+        :param rows: evaluate the batch in blocks of this many output rows, 0 to disable
+        :return: {method name: output image} for each image
+        """
+        function = partial(Contrast.apply_rows, self.outputs, halo=self.halo, rows=rows) if rows else self.outputs
+        if bands > 1:
+            function = partial(Contrast.apply_banded, function, halo=self.halo, bands=bands)
+        return Contrast.apply_stacked(function, images)
+
+    def bytes_per_pixel(self) -> float:
+        """
+        Peak memory of applying the plan to a colour image, including the decoded image, per pixel. Measured once on
+        a small synthetic image, an upper bound when the image is evaluated in tiles or row blocks
+        """
+        if self._bytes_per_pixel is None:
+            image = numpy.random.default_rng(0).integers(0, 256, (512, 512, 3), numpy.uint8)
+            with Profile.excluded(), Profile.allocation() as allocated:
+                self.outputs(image)
+            self._bytes_per_pixel = (allocated[0] + image.nbytes) / (image.shape[0] * image.shape[1])
+        return self._bytes_per_pixel
 
-    for parse in method:
-        if isinstance(parse, tuple):
-            data = [image(w) for w in parse[0]]
-            data = Contrast.resize_list_of_arrays(data)
-            data_list.append(Contrast.combine_array_list(data, parse[1]))
-        elif isinstance(parse, int):
-            data_list.append(image(window=parse))
+    def outputs(self, image) -> dict:
+        """ every output of the plan for an image array as {method name: output image} """
+        return dict(self.run(self.image_cache(image)))
 
-    data = Contrast.resize_list_of_arrays(data_list)
-    output_image = Contrast.combine_array_list(data, method[-1])
+    def __repr__(self):
+        return f"PresetPlan({list(self.methods)}, windows={len(self.window_uses)}, groups={len(self.group_uses)})"
 
-    file_output = file.parent / sub_folder_name / file.parts[-1]
-    IO.export_image(file_output, output_image)
+    def run(self, image: Contrast.ImageCache):
+        """
+        Evaluate every method of the plan against one image
+        :param image: ImageCache of the loaded image
+        :return: generator of (method name, output image)
+        """
+        # the image cache drops each window result after its last planned read
+        for (window, kernel), uses in self.window_uses.items():
+            image.expect(window, uses, kernel=kernel)
+        group_uses = dict(self.group_uses)
+        group_results = {}
+
+        def window_result(node):
+            return image(node[0], kernel=node[1])
+
+        def group_result(node):
+            if node not in group_results:
+                windows, combine, kernel = node
+                group_results[node] = image.combine(list(windows), combine, kernel)
+            data = group_results[node]
+            group_uses[node] -= 1
+            if group_uses[node] == 0:
+                del group_results[node]
+            return data
+
+        for name, (parts, combine) in self.methods.items():
+            with Profile.section('preset', name):
+                # parts are added to the output as they are produced
+                windows = [w for kind, node in parts for w in (node[0] if kind == 'group' else [node[0]])]
+                combiner = Contrast.Combiner(combine, len(parts),
+                                             Contrast.window_output_shape(image.image.shape, windows))
+                for kind, node in parts:
+                    combiner.add(group_result(node) if kind == 'group' else window_result(node))
+                output_image = combiner.result()
+            yield name, output_image
 
 
 # --------------------------------------------------------------------------------------------------------------
 # ---------------------------Multi Processing Function ---------------------------------------------------------
 # --------------------------------------------------------------------------------------------------------------
-from multiprocessing import Pool
+import ctypes
+import queue
+import threading
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import Process
 from os import cpu_count
 
 core_count = max(cpu_count() - 2, 1)
 
 
-def quick_pool(function: Callable, data_list: list) -> list:
-    with Pool(core_count) as p:
-        return p.map(function, data_list)
+# used for functions other than preset plans, roughly a colour image with a handful of float64 window results
+default_bytes_per_pixel = 200
+
+
+class _MemoryStatus(ctypes.Structure):
+    """ MEMORYSTATUSEX, filled in by GlobalMemoryStatusEx on Windows """
+    _fields_ = [('length', ctypes.c_ulong), ('memory_load', ctypes.c_ulong),
+                ('total_physical', ctypes.c_ulonglong), ('available_physical', ctypes.c_ulonglong),
+                ('total_page_file', ctypes.c_ulonglong), ('available_page_file', ctypes.c_ulonglong),
+                ('total_virtual', ctypes.c_ulonglong), ('available_virtual', ctypes.c_ulonglong),
+                ('available_extended_virtual', ctypes.c_ulonglong)]
+
+
+def available_memory() -> int or None:
+    """
+    bytes of memory available for new work, from /proc/meminfo, else half of the physical memory, else the available
+    physical memory on Windows
+    :return: None where none of these can be read
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if hasattr(os, 'sysconf'):
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+        except (ValueError, OSError):
+            pass
+    if hasattr(ctypes, 'windll'):
+        status = _MemoryStatus()
+        status.length = ctypes.sizeof(_MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.available_physical
+    return None
+
+
+def file_footprint(file: pathlib.Path, bytes_per_pixel: float) -> int:
+    """ expected peak memory of processing an image file, from the size in its header or else its file size """
+    size = IO.image_size(file)
+    pixels = size[0] * size[1] if size else file.stat().st_size
+    return int(pixels * bytes_per_pixel)
+
+
+@Profile.stage('schedule', lambda function, files, bytes_per_pixel, memory_budget=None, workers=core_count:
+               f'{workers} workers')
+def schedule_files(function: Callable, files: Iterable[pathlib.Path], bytes_per_pixel: float,
+                   memory_budget: int or None = None, workers: int = core_count) -> dict:
+    """
+    Apply function to every file in a process pool, largest images first so large images don't hold up the end of
+    the run. Files are handed out one at a time as workers free up, and only while the expected footprint of the
+    files being processed stays within the memory budget, so many large images never run at once.
+    Image sizes are read from the file headers, see IO.image_size
+    :param bytes_per_pixel: expected peak memory of function per pixel, see PresetPlan.bytes_per_pixel
+    :param memory_budget: bytes all workers may use together, by default the memory available now. A file larger
+        than the budget is processed on its own. Where the available memory can't be read there is no budget and
+        files are only ordered largest first
+    :param workers: most files processed at once
+    :return: {file: result of function}
+    """
+    budget = memory_budget or available_memory()
+    pending = sorted(((file_footprint(file, bytes_per_pixel), file) for file in files),
+                     key=lambda item: item[0], reverse=True)
+    results = {}
+    if not pending:
+        return results
+    workers = max(1, min(workers, len(pending)))
+    in_use = 0
+    running = {}
+    with ProcessPoolExecutor(workers) as pool:
+        while pending or running:
+            # the largest waiting file that fits, anything when nothing else is running
+            while pending and len(running) < workers:
+                index = next((i for i, (footprint, _) in enumerate(pending)
+                              if budget is None or not running or in_use + footprint <= budget), None)
+                if index is None:
+                    break
+                footprint, file = pending.pop(index)
+                running[pool.submit(function, file)] = footprint, file
+                in_use += footprint
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                footprint, file = running.pop(future)
+                in_use -= footprint
+                results[file] = future.result()
+    return results
+
+
+# ---------------------------Streaming Pipeline ----------------------------------------------------------------
+_stage_done = object()  # sentinel passed down the queues once a stage has no more work
+
+
+def _start_stage(function: Callable, inbox: queue.Queue, outbox: queue.Queue or None, workers: int,
+                 outbox_readers: int) -> list[threading.Thread]:
+    """
+    Start [workers] threads applying function to every item of inbox, function returns an iterable of results
+    which are placed on outbox as they are produced. When the last worker finishes, outbox receives one
+    sentinel per reader. Errors are reported and the item is skipped.
+    """
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def work():
+        while (item := inbox.get()) is not _stage_done:
+            try:
+                for result in function(item):
+                    if outbox is not None:
+                        outbox.put(result)
+            except Exception as e:
+                print(f'{type(e).__name__}: \n\t\t{item if isinstance(item, pathlib.Path) else item[0]}  \n{e}')
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            for _ in range(outbox_readers):
+                outbox.put(_stage_done)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _run_plan(plan: PresetPlan, image, tile: int = 0, disk_cache: Cache.DiskCache or None = None,
+              rows: int = 0) -> list:
+    """ process pool entry point, runs a full plan and returns every output """
+    return list(plan.apply(image, tile, disk_cache=disk_cache, rows=rows))
+
+
+def batch_plan_in_folder(folder: str, plan: PresetPlan, allow_sub_folders=False, batch_size: int = 16,
+                         bands: int = 1, rows: int = 0, cache: Cache.DiskCache or None = None):
+    """
+    Run a plan over a folder, processing same shape images together in batches, see batch_plan_on_files
+    :param folder: directory of files
+    :param plan: compiled methods, outputs go to file.parent / method name / file name
+    :param allow_sub_folders: include files in sub folders, output folders of the plan are skipped
+    :param batch_size: maximum images processed at once
+    :param bands: number of row bands of each batch processed in parallel, 1 to disable
+    :param rows: evaluate each batch in blocks of this many output rows, 0 to disable
+    :param cache: optional cache of outputs and intermediate results kept between runs
+    """
+    files = IO.iter_files(IO.assign_path(folder), allow_sub_folders, set(plan.methods))
+    batch_plan_on_files(files, plan, batch_size, bands, rows, cache)
+
+
+def batch_plan_on_files(files: Iterable[pathlib.Path], plan: PresetPlan, batch_size: int = 16, bands: int = 1,
+                        rows: int = 0, cache: Cache.DiskCache or None = None) -> dict[pathlib.Path, str]:
+    """
+    Run a plan over files, processing same shape images together in batches with PresetPlan.apply_batch.
+    Files are grouped by image shape as they are loaded, each group is processed once it holds [batch_size] images
+    and any partial groups are processed after the last file.
+    Batching saves the per image overhead, which matters for small frames, larger images gain little as the work
+    is dominated by memory bandwidth and each batch also computes the rows lost at the bottom of every image
+    :return: error of each file that could not be read or processed, the other files are still processed
+    """
+    # (shape, dtype, methods still to compute) -> [(file, image, plan, cache keys)]
+    batches: dict[tuple, list[tuple]] = {}
+    failures: dict[pathlib.Path, str] = {}
+
+    def run(group):
+        items = batches.pop(group)
+        try:
+            results = items[0][2].apply_batch([image for _, image, _, _ in items], bands, rows)
+        except Exception as e:
+            print(f"Batch of {len(items)} files failed: {type(e).__name__}: {e}")
+            failures.update((file, f'{type(e).__name__}: {e}') for file, _, _, _ in items)
+            return
+        for (file, _, _, keys), outputs in zip(items, results):
+            try:
+                for name, output_image in outputs.items():
+                    if name in keys:
+                        cache.put(keys[name], output_image)
+                    export_output(file, name, output_image)
+            except Exception as e:
+                print(f"Failed to write outputs of {file}: {type(e).__name__}: {e}")
+                failures[file] = f'{type(e).__name__}: {e}'
+
+    for file in files:
+        file_plan, keys = plan, {}
+        if cache is not None:
+            outputs, file_plan, keys = lookup_plan(file, plan, cache)
+            for name, output_image in outputs.items():
+                export_output(file, name, output_image)
+            if file_plan is None:
+                continue
+        image = IO.load_image(file)
+        if image is None:
+            print(f"Skipping unreadable file: {file}")
+            failures[file] = f"Unreadable input, could not read image: {file}"
+            continue
+        group = image.shape, image.dtype.str, tuple(file_plan.methods)
+        batches.setdefault(group, []).append((file, image, file_plan, keys))
+        if len(batches[group]) >= batch_size:
+            run(group)
+    for group in list(batches):
+        run(group)
+    return failures
+
+
+def stream_plan_in_folder(folder: str, plan: PresetPlan, allow_sub_folders=False, io_workers: int = 4,
+                          compute_workers: int = core_count, queue_depth: int = 8, processes: bool = False,
+                          tile: int = 0, bands: int = 1, cache: Cache.DiskCache or None = None, rows: int = 0):
+    """
+    Run a plan over a folder as a pipeline of bounded queues: files are listed lazily, decoded by a pool of
+    io threads, processed by a pool of compute workers and written by a second pool of io threads as soon as each
+    output is ready. cv2.imread / imwrite and the numpy stdev stages release the GIL so the stages overlap.
+    Full queues block the stage before them, so memory stays flat however large the folder is.
+    :param folder: directory of files
+    :param plan: compiled methods, outputs go to file.parent / method name / file name
+    :param allow_sub_folders: include files in sub folders, output folders of the plan are skipped
+    :param io_workers: threads used for each of loading and writing
+    :param compute_workers: number of images processed at once
+    :param queue_depth: maximum images waiting between two stages
+    :param processes: run the compute stage in a process pool instead of threads
+    :param tile: process each image in tiles of this many pixels per side, 0 to disable
+    :param bands: number of row bands of each image processed in parallel, ignored when using a process pool
+    :param cache: optional cache of outputs and intermediate results kept between runs
+    :param rows: evaluate each image in blocks of this many output rows, 0 to disable
+    """
+    files = queue.Queue(queue_depth)
+    loaded = queue.Queue(queue_depth)
+    computed = queue.Queue(queue_depth)
+    pool = ProcessPoolExecutor(compute_workers) if processes else None
+
+    def load(file):
+        file_plan, keys = plan, {}
+        if cache is not None:  # cached outputs go straight to the writers, the file is decoded only if needed
+            outputs, file_plan, keys = lookup_plan(file, plan, cache)
+            for name, output_image in outputs.items():
+                computed.put((file, name, output_image))
+            if file_plan is None:
+                return
+        image = IO.load_image(file)
+        if image is None:
+            print(f"Skipping unreadable file: {file}")
+            return
+        yield file, image, file_plan, keys
+
+    def compute(item):
+        file, image, file_plan, keys = item
+        if processes:
+            outputs = pool.submit(_run_plan, file_plan, image, tile, cache, rows).result()
+        else:
+            outputs = file_plan.apply(image, tile, bands, cache, rows)
+        for name, output_image in outputs:
+            if name in keys:
+                cache.put(keys[name], output_image)
+            yield file, name, output_image
+
+    def export(item):
+        export_output(*item)
+        return ()
+
+    threads = _start_stage(load, files, loaded, io_workers, compute_workers)
+    threads += _start_stage(compute, loaded, computed, compute_workers, io_workers)
+    threads += _start_stage(export, computed, None, io_workers, 0)
+    try:
+        for file in IO.iter_files(IO.assign_path(folder), allow_sub_folders, set(plan.methods)):
+            files.put(file)
+        for _ in range(io_workers):
+            files.put(_stage_done)
+        for thread in threads:
+            thread.join()
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -94,17 +661,125 @@ if __name__ == '__main__':
     parser.add_argument("-asf", "--allow_sub_folders", dest="sub_folder",
                         help="run function on all sub-folders of the given directory",
                         action=argparse.BooleanOptionalAction, default=False)
-    parser.add_argument("-m", "--multicore", dest="multicore", help="use multiple CPU cores",
+    parser.add_argument("-m", "--multicore", dest="multicore",
+                        help="use multiple CPU cores, files are processed largest first as memory allows",
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("-mem", "--memory_limit", dest="memory_limit",
+                        help="GB all -m workers may use together, 0 for the memory available at the start",
+                        type=float, default=0)
+    parser.add_argument("-s", "--stream", dest="stream",
+                        help="overlap loading, processing and writing files, with -m processing uses a process pool",
                         action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("-io", "--io_workers", dest="io_workers", help="threads used to load and to write files",
+                        type=int, default=4)
+    parser.add_argument("-t", "--tile", dest="tile",
+                        help="process large images in tiles of this many pixels per side, 0 to disable",
+                        type=int, default=0)
+    parser.add_argument("-r", "--rows", dest="rows",
+                        help="evaluate each image in blocks of this many output rows so only the final outputs are "
+                             "held at full size, 0 to disable",
+                        type=int, default=0)
+    parser.add_argument("-b", "--bands", dest="bands",
+                        help="split each image into this many row bands processed in parallel, 1 to disable",
+                        type=int, default=1)
+    parser.add_argument("-cache", "--cache", dest="cache",
+                        help="folder used to keep results between runs, unchanged inputs are not processed again")
+    parser.add_argument("-cache_size", "--cache_size", dest="cache_size", help="cache size budget in GB",
+                        type=float, default=10)
+    parser.add_argument("-p", "--precision", dest="precision", help="dtype used for stdev results",
+                        choices=Contrast.precision_options(), default=None)
+    parser.add_argument("-mb", "--memory_budget", dest="memory_budget",
+                        help="GB of window results kept per image, older results are recomputed when needed",
+                        type=float, default=0)
+    parser.add_argument("-bs", "--batch_size", dest="batch_size",
+                        help="process up to this many same sized images together, faster for small frames, "
+                             "0 to process files one at a time",
+                        type=int, default=0)
+    parser.add_argument("-of", "--output_format", dest="output_format",
+                        help="suffix of output files, e.g. '.npy' to keep raw values for a later pass without "
+                             "encoding, by default the suffix of each input")
+    parser.add_argument("-normalise", "--normalise", dest="normalise",
+                        help="stretch outputs over the full range of the image format, not used for .npy outputs",
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("-profile", "--profile", dest="profile", nargs='?', const='',
+                        help="print the time and memory of each stage, optionally write a json trace to the given "
+                             "file, work in other processes (bands, multicore) is only timed as a whole, use -b 1 "
+                             "to see its stages")
+    parser.add_argument("-manifest", "--manifest", dest="manifest", nargs='?', const='',
+                        help="only process files that are new or changed since the last run and resume interrupted "
+                             "runs, records go to the given file or [directory]/.manifest.jsonl, "
+                             "files are processed one at a time")
+    parser.add_argument("-watch", "--watch", dest="watch",
+                        help="keep running and process files as they land in the directory, implies -manifest",
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("-watch_interval", "--watch_interval", dest="watch_interval",
+                        help="seconds between checks of the directory when watching", type=float, default=2)
+    parser.add_argument("-queue", "--queue", dest="queue", nargs='?', const='',
+                        help="share the files between workers on any number of machines through a work queue at the "
+                             "given file or [directory]/.queue.sqlite on a shared filesystem, every machine runs the "
+                             "same command, the directory is queued by whichever starts first")
+    parser.add_argument("-workers", "--workers", dest="workers", help="worker processes on this machine with -queue",
+                        type=int, default=1)
+    parser.add_argument("-lease", "--lease", dest="lease",
+                        help="seconds before a file claimed by a worker that stopped responding is claimed again",
+                        type=float, default=600)
+    parser.add_argument("-attempts", "--attempts", dest="attempts", help="tries per file before it is given up on",
+                        type=int, default=3)
+    parser.add_argument("-q", "--queue_depth", dest="queue_depth", help="images held between pipeline stages",
+                        type=int, default=8)
     args = parser.parse_args()
     print(args)
+    if args.profile is not None:
+        Profile.enable()
     use_multi_core_processing = args.multicore
+    multi_core_memory_budget = int(args.memory_limit * 2 ** 30) if args.memory_limit else None
+    if args.output_format:
+        output_suffix = '.' + args.output_format.lstrip('.')
+    normalise_output = args.normalise
     if args.function.strip().lower() == 'all':
-        for name in named_methods:
-            apply_in_folder(folder=args.directory, function=apply_to_file, method=named_methods[name],
-                            allow_sub_folders=args.sub_folder, sub_folder_name=name)
+        func_list = list(named_methods)
     else:
         func_list = [a for a in args.function.split(',') if a in named_methods]
-        for name in func_list:
-            apply_in_folder(folder=args.directory, function=apply_to_file, method=named_methods[name],
-                            allow_sub_folders=args.sub_folder, sub_folder_name=name)
+    # every file is loaded once and shared windows are computed once for all requested methods
+    plan = PresetPlan({name: named_methods[name] for name in func_list}, args.precision,
+                      int(args.memory_budget * 2 ** 30) if args.memory_budget else None)
+    cache = Cache.DiskCache(args.cache, int(args.cache_size * 2 ** 30)) if args.cache else None
+    if args.queue is not None:
+        queue_path = args.queue or IO.assign_path(args.directory) / '.queue.sqlite'
+        work_queue = WorkQueue.WorkQueue(queue_path, args.lease, args.attempts)
+        if args.directory:
+            print(f"Queued {enqueue_folder(args.directory, work_queue, plan, args.sub_folder)} new file(s)")
+        worker_args = (queue_path, plan, args.lease, args.attempts, args.tile, args.bands, args.rows, cache)
+        workers = [Process(target=work_from_queue, args=worker_args) for _ in range(args.workers - 1)]
+        for worker in workers:
+            worker.start()
+        work_from_queue(*worker_args)
+        for worker in workers:
+            worker.join()
+        print(work_queue)
+        for name, error in work_queue.failures():
+            print(f"Failed: {name}: {error}")
+        work_queue.close()
+    elif args.manifest is not None or args.watch:
+        manifest = Manifest.Manifest(args.manifest or IO.assign_path(args.directory) / '.manifest.jsonl')
+        options = dict(tile=args.tile, bands=args.bands, rows=args.rows, cache=cache)
+        if args.watch:
+            watch_folder(args.directory, plan, manifest, args.sub_folder, args.watch_interval, **options)
+        else:
+            print(f"Processed {update_folder(args.directory, plan, manifest, args.sub_folder, **options)} file(s)")
+    elif args.batch_size:
+        batch_plan_in_folder(folder=args.directory, plan=plan, allow_sub_folders=args.sub_folder,
+                             batch_size=args.batch_size, bands=args.bands, rows=args.rows, cache=cache)
+    elif args.stream:
+        stream_plan_in_folder(folder=args.directory, plan=plan, allow_sub_folders=args.sub_folder,
+                              io_workers=args.io_workers, queue_depth=args.queue_depth, processes=args.multicore,
+                              tile=args.tile, bands=args.bands, cache=cache, rows=args.rows)
+    else:
+        apply_in_folder(folder=args.directory, function=apply_plan_to_file, plan=plan,
+                        allow_sub_folders=args.sub_folder, tile=args.tile, bands=args.bands, cache=cache,
+                        rows=args.rows)
+
+    if args.profile is not None:
+        print(Profile.report())
+        if args.profile:
+            Profile.write_trace(args.profile)
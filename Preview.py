@@ -0,0 +1,113 @@
+import pathlib
+import tempfile
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy
+
+import IO
+
+# Low latency previews: stdev and combine run on a level of the image pyramid small enough to keep up, with window
+# sizes scaled to match, while full resolution renders wait their turn in a background thread.
+default_max_pixels = 640 * 360
+# cv2 decodes jpeg at 1/2, 1/4 and 1/8 size for much less than a full decode
+_reduced_colour = {1: cv2.IMREAD_REDUCED_COLOR_2, 2: cv2.IMREAD_REDUCED_COLOR_4, 3: cv2.IMREAD_REDUCED_COLOR_8}
+_reduced_grey = {1: cv2.IMREAD_REDUCED_GRAYSCALE_2, 2: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                 3: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+_render_queue: ThreadPoolExecutor or None = None
+_headless_file: pathlib.Path or None = None
+
+
+def pyramid_level(shape: tuple, max_pixels: int = default_max_pixels) -> int:
+    """ :return: number of halvings of an image of shape (height, width, ...) to fit within max_pixels """
+    level = 0
+    height, width = shape[:2]
+    while height * width > max_pixels and min(height, width) > 1:
+        height, width = (height + 1) // 2, (width + 1) // 2
+        level += 1
+    return level
+
+
+def pyramid_down(image: numpy.ndarray, level: int) -> numpy.ndarray:
+    """ image blurred and halved [level] times, see cv2.pyrDown """
+    image = numpy.asarray(image)
+    for _ in range(level):
+        image = cv2.pyrDown(image)
+    return image
+
+
+def scale_window(window: int or tuple[int, int], level: int) -> int or tuple[int, int]:
+    """ window size covering the same part of the image at a pyramid level, at least 2 so stdev is not always 0 """
+    if isinstance(window, tuple):
+        return tuple(scale_window(w, level) for w in window)
+    return max(2, round(window / 2 ** level))
+
+
+def scale_windows(window: int or list, level: int) -> int or list:
+    """ scale_window for a single window or a list of windows """
+    if isinstance(window, list):
+        return [scale_window(w, level) for w in window]
+    return scale_window(window, level)
+
+
+def load_level(file: pathlib.Path, rgb: bool = True,
+               max_pixels: int = default_max_pixels) -> tuple[numpy.ndarray or None, int]:
+    """
+    Load an image at the pyramid level fitting within max_pixels, jpeg files are decoded at reduced size when the
+    size can be read from the header, see IO.image_size
+    :return: (image or None if unreadable, level)
+    """
+    size = IO.image_size(file)
+    if size is None or file.suffix.lower() in IO.raw_extensions:
+        image = IO.load_image(file, rgb)
+        if image is None:
+            return None, 0
+        level = pyramid_level(image.shape, max_pixels)
+        return pyramid_down(image, level), level
+    level = pyramid_level(size, max_pixels)
+    reduced = min(level, 3)
+    if reduced:
+        image = cv2.imread(file.as_posix(), (_reduced_colour if rgb else _reduced_grey)[reduced])
+    else:
+        image = IO.load_image(file, rgb)
+    if image is None:
+        return None, 0
+    return pyramid_down(image, level - reduced), level
+
+
+def show(image: numpy.ndarray, title: str = 'preview') -> int or None:
+    """
+    Show an image in a window and poll the keyboard
+    :return: key pressed or -1, None where there is no display, the image is written to a temporary file instead
+    """
+    global _headless_file
+    try:
+        cv2.imshow(title, image)
+        key = cv2.waitKey(1)
+        return key & 0xFF if key != -1 else -1
+    except cv2.error:
+        if _headless_file is None:
+            _headless_file = pathlib.Path(tempfile.gettempdir()) / 'preview.png'
+            print(f"No display, previews are written to {_headless_file}")
+        cv2.imwrite(_headless_file.as_posix(), image)
+        return None
+
+
+def render_queue() -> ThreadPoolExecutor:
+    """ queue of full resolution renders, run one at a time in a background thread in the order they were queued """
+    global _render_queue
+    if _render_queue is None:
+        _render_queue = ThreadPoolExecutor(1, thread_name_prefix='render')
+    return _render_queue
+
+
+def queue_render(function: Callable, *args, **kwargs) -> Future:
+    """ queue function(*args, **kwargs) on the render queue, exceptions are printed once it has run """
+    future = render_queue().submit(function, *args, **kwargs)
+
+    def report(done: Future):
+        if done.exception() is not None:
+            print(f"Render failed: {type(done.exception()).__name__}: {done.exception()}")
+    future.add_done_callback(report)
+    return future
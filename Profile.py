@@ -0,0 +1,209 @@
+import json
+import pathlib
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+import numpy
+
+# Per stage instrumentation. Functions marked with @stage and blocks wrapped in section() record wall time, calls,
+# output bytes, the size of the arrays they return, and the peak memory allocated while they run, traced with
+# tracemalloc, once enable() has been called. Until then each costs one flag check.
+# Times and allocations include nested stages, allocations made by other threads at the same time are counted too.
+# Work done in other processes (bands, process pools) is only recorded as the total time of the stage waiting on it.
+enabled = False
+_lock = threading.Lock()
+_start = 0.0
+_started_tracing = False
+# per thread: stages running, each as [traced memory at the start, peak seen before the last nested stage], and
+# how many excluded() blocks are open
+_local = threading.local()
+# (stage, detail) -> [calls, seconds, output bytes, largest peak allocation of a call]
+_totals: dict[tuple[str, str], list] = {}
+# trace events in the chrome trace event format, readable by chrome://tracing and perfetto
+_events: list[dict] = []
+
+
+def enable():
+    """ start recording and tracing allocations, clears anything recorded before """
+    global enabled, _start, _started_tracing
+    with _lock:
+        _totals.clear()
+        _events.clear()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _start = time.perf_counter()
+        enabled = True
+
+
+def disable():
+    global enabled, _started_tracing
+    enabled = False
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+
+def _stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _recording() -> bool:
+    return enabled and not getattr(_local, 'excluded', 0)
+
+
+@contextmanager
+def excluded():
+    """ leave the stages run in this block, in this thread, out of the records, e.g. small probe runs """
+    _local.excluded = getattr(_local, 'excluded', 0) + 1
+    try:
+        yield
+    finally:
+        _local.excluded -= 1
+
+
+def _begin_allocation() -> list or None:
+    """ start measuring the peak allocation of a stage, see _end_allocation """
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    stack = _stack()
+    if stack:  # the peak is reset below, keep what the enclosing stage has reached so far
+        stack[-1][1] = max(stack[-1][1], peak)
+    tracemalloc.reset_peak()
+    frame = [current, current]
+    stack.append(frame)
+    return frame
+
+
+def _end_allocation(frame: list or None) -> int:
+    """ :return: bytes allocated at the peak of the stage above what was allocated when it started """
+    if frame is None or not tracemalloc.is_tracing():
+        return 0
+    stack = _stack()
+    stack.remove(frame)
+    peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    return peak - frame[0]
+
+
+def _nbytes(result) -> int:
+    """ bytes of the arrays in a result, including arrays inside dicts, lists and tuples """
+    if isinstance(result, numpy.ndarray):
+        return result.nbytes
+    if isinstance(result, dict):
+        return sum(_nbytes(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(_nbytes(value) for value in result)
+    return 0
+
+
+@contextmanager
+def allocation():
+    """
+    Measure the peak memory allocated in a block above what was allocated when it started, tracing allocations for
+    the block if they aren't traced already. Yields a list holding the bytes once the block has run
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    frame = _begin_allocation()
+    allocated = [0]
+    try:
+        yield allocated
+    finally:
+        allocated[0] = _end_allocation(frame)
+        if not tracing:
+            tracemalloc.stop()
+
+
+def record(name: str, detail: str, start: float, seconds: float, nbytes: int = 0, allocated: int = 0):
+    with _lock:
+        totals = _totals.setdefault((name, detail), [0, 0.0, 0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += nbytes
+        totals[3] = max(totals[3], allocated)
+        _events.append({'name': name if not detail else f'{name} {detail}', 'cat': name, 'ph': 'X',
+                        'ts': (start - _start) * 1e6, 'dur': seconds * 1e6, 'pid': 0,
+                        'tid': threading.get_ident(),
+                        'args': {'output_bytes': nbytes, 'allocated_bytes': allocated}})
+
+
+def stage(name: str, detail: Callable or None = None):
+    """
+    Decorator recording every call of a function as a stage
+    :param name: stage name, e.g. 'decode'
+    :param detail: optional function given the same arguments as the decorated function, returning the sub stage
+        the call is counted under, e.g. the window size
+    """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled or not _recording():
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            frame = _begin_allocation()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                allocated = _end_allocation(frame)
+            record(name, '' if detail is None else str(detail(*args, **kwargs)), start,
+                   time.perf_counter() - start, _nbytes(result), allocated)
+            return result
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def _section(name: str, detail: str):
+    start = time.perf_counter()
+    frame = _begin_allocation()
+    try:
+        yield
+    finally:
+        allocated = _end_allocation(frame)
+        record(name, detail, start, time.perf_counter() - start, allocated=allocated)
+
+
+def section(name: str, detail='') -> contextmanager:
+    """ context manager recording a block of code as a stage, for work that isn't a single function call """
+    if not enabled or not _recording():
+        return nullcontext()
+    return _section(name, str(detail))
+
+
+def summary() -> list[dict]:
+    """ :return: totals of every stage and detail, longest first """
+    with _lock:
+        rows = [{'stage': name, 'detail': detail, 'calls': calls, 'seconds': seconds, 'output_bytes': nbytes,
+                 'allocated_bytes': allocated}
+                for (name, detail), (calls, seconds, nbytes, allocated) in _totals.items()]
+    return sorted(rows, key=lambda row: row['seconds'], reverse=True)
+
+
+def report() -> str:
+    """ summary as a table for printing """
+    lines = [f"{'stage':<14} {'detail':<18} {'calls':>7} {'total s':>9} {'mean ms':>9} {'output MB':>10} "
+             f"{'peak alloc MB':>14}"]
+    for row in summary():
+        lines.append(f"{row['stage']:<14} {row['detail']:<18} {row['calls']:>7} {row['seconds']:>9.3f} "
+                     f"{row['seconds'] / row['calls'] * 1e3:>9.2f} {row['output_bytes'] / 2 ** 20:>10.1f} "
+                     f"{row['allocated_bytes'] / 2 ** 20:>14.1f}")
+    lines.append(f"wall time {time.perf_counter() - _start:.3f}s, stage times and allocations include nested stages, "
+                 f"peak alloc is the largest of any call")
+    return '\n'.join(lines)
+
+
+def write_trace(file: pathlib.Path or str):
+    """ write every recorded event and the summary as json in the chrome trace event format """
+    with _lock:
+        events = list(_events)
+    pathlib.Path(file).write_text(json.dumps({'traceEvents': events, 'summary': summary()}))
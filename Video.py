@@ -1,25 +1,40 @@
 import math
 import pathlib
+import queue
+import threading
 import time
-from collections.abc import Callable
+from collections.abc import Callable, Iterable
+from os import cpu_count
 
 import cv2
 import numpy
 
 import Contrast
+import IO
+import Preview
+import Profile
+
+
+core_count = max(cpu_count() - 2, 1)
+_end_of_stream = object()  # sentinel passed from the reader to the workers and on to the writer
 
 
 def apply_without_ram_buffer(in_file: pathlib.Path, out_file: pathlib.Path, function: Callable, fps=30,
-                             output_size=(0, 0), padding_=0, view_=False,
-                             **kwargs) -> None:
+                             output_size=(0, 0), padding_=0, view_=False, workers: int = core_count,
+                             queue_depth: int = 16, **kwargs) -> None:
     """
+    Frames are read by a reader thread, processed by a pool of worker threads and written in their original order,
+    at most [queue_depth] frames are held in memory at once
     @param in_file: input filepath
     @param out_file: output filepath
     @param function: function to be applied over a 2d array size[x,y] or 3d array size[x,y,z] defined by split_BGR
     @param fps: output fps
     @param output_size: size of the output (W,H), if (0,0) input size will be used and padding added
     @param padding_: int in range 0,255 - padding unit to be used in outputs when output is set to (0,0)
-    @param view_: show output in realtime
+    @param view_: show output in realtime, at a pyramid level of at most Preview.default_max_pixels, frames are
+        shown at [fps] and skipped from the view when processing falls behind
+    @param workers: number of frames processed at once
+    @param queue_depth: maximum number of frames between the reader and the writer
     @param kwargs: parsed directly to function as **kwargs
     """
     padding_ = numpy.ubyte(padding_)
@@ -30,6 +45,7 @@ def apply_without_ram_buffer(in_file: pathlib.Path, out_file: pathlib.Path, func
         out_file = out_file.with_suffix('.avi')
 
     # main components
+    capture = output = None
     try:
         # Input Settings
         capture = cv2.VideoCapture(in_file.__str__())
@@ -51,32 +67,262 @@ def apply_without_ram_buffer(in_file: pathlib.Path, out_file: pathlib.Path, func
                                  fps=fps,
                                  frameSize=(output_size[0], output_size[1]))
 
-        # Settings
-        frame = 0
-        return_value = True
-        while frame < frame_count and return_value:
-            return_value, current_frame = capture.read()
-            frame += 1
-            current_frame = Contrast.apply_rgb(function, current_frame, **kwargs)
-            current_frame = current_frame.astype('uint8')
-            if current_frame.shape != (frame_height, frame_width, 3):
-                current_frame = numpy.pad(current_frame,
-                                          padding_size(current_frame.shape),
-                                          mode='constant',
-                                          constant_values=(padding_, padding_))
-            output.write(current_frame)
-            if view_:
-                cv2.imshow('frame', current_frame)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
+        # Pipeline
+        in_flight = threading.Semaphore(queue_depth)  # released by the writer once a frame is written
+        stop = threading.Event()
+        frames_in = queue.Queue()
+        frames_out = queue.Queue()
+
+        def reader():
+            frame = 0
+            while frame < frame_count and not stop.is_set():
+                in_flight.acquire()
+                with Profile.section('decode', 'video'):
+                    return_value, current_frame = capture.read()
+                if not return_value:
                     break
-                time.sleep(1 / fps)
+                frames_in.put((frame, current_frame))
+                frame += 1
+            for _ in range(workers):
+                frames_in.put(_end_of_stream)
 
-        # Release all items
-        capture.release()
-        output.release()
+        def worker():
+            while (item := frames_in.get()) is not _end_of_stream:
+                if stop.is_set():
+                    continue
+                sequence, current_frame = item
+                try:
+                    frames_out.put((sequence, Contrast.apply(function, current_frame, **kwargs)))
+                except Exception as e:
+                    frames_out.put((sequence, e))
+            frames_out.put(_end_of_stream)
+
+        threads = [threading.Thread(target=reader, daemon=True)]
+        threads += [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        # Writer, frames finish out of order and are held until every earlier frame has been written
+        view_level = Preview.pyramid_level((frame_height, frame_width))
+        view_start = time.perf_counter()
+        pending = {}
+        next_frame = 0
+        finished_workers = 0
+        try:
+            while finished_workers < workers and not stop.is_set():
+                item = frames_out.get()
+                if item is _end_of_stream:
+                    finished_workers += 1
+                    continue
+                pending[item[0]] = item[1]
+                while next_frame in pending and not stop.is_set():
+                    current_frame = pending.pop(next_frame)
+                    next_frame += 1
+                    in_flight.release()
+                    if isinstance(current_frame, Exception):
+                        raise current_frame
+                    current_frame = current_frame.astype('uint8')
+                    if current_frame.shape != (frame_height, frame_width, 3):
+                        current_frame = numpy.pad(current_frame,
+                                                  padding_size(current_frame.shape),
+                                                  mode='constant',
+                                                  constant_values=(padding_, padding_))
+                    with Profile.section('encode', 'video'):
+                        output.write(current_frame)
+                    if view_:
+                        # wait for the frame's time rather than a whole frame, late frames are not shown at all
+                        delay = next_frame / fps - (time.perf_counter() - view_start)
+                        if delay > 0:
+                            time.sleep(delay)
+                        if delay > -1 / fps and Preview.show(Preview.pyramid_down(current_frame, view_level),
+                                                              'frame') == ord('q'):
+                            stop.set()
+        finally:
+            # wake the reader so it sees the stop flag, workers skip the frames still queued
+            stop.set()
+            in_flight.release()
+            for thread in threads:
+                thread.join()
 
     except FileNotFoundError as fnf:
         print(f'FileNotFoundError: \n\t\t{in_file}\n\t\t{out_file}  \n{fnf}')
         exit(1)
     finally:
+        # Release all items
+        if capture is not None:
+            capture.release()
+        if output is not None:
+            output.release()
+        if view_:
+            _destroy_windows()
+
+
+def _destroy_windows():
+    """ close the view windows, headless builds of cv2 raise rather than having no windows to close """
+    try:
         cv2.destroyAllWindows()
+    except cv2.error:
+        pass
+
+
+def _scaled_kwargs(kwargs: dict, level: int) -> dict:
+    """ kwargs with the window, if any, scaled to a pyramid level """
+    if 'window' not in kwargs:
+        return kwargs
+    return dict(kwargs, window=Preview.scale_windows(kwargs['window'], level))
+
+
+def preview_video(in_file: pathlib.Path, function: Callable, fps=30, max_pixels: int = Preview.default_max_pixels,
+                  **kwargs) -> bool or None:
+    """
+    Show function applied to a level of the video pyramid small enough to keep up in real time, the window in kwargs
+    is scaled to the level. Frames the preview is too late for are skipped rather than queued, the clip loops until
+    the parameters are confirmed with enter or 'y', or dropped with 'q' or escape
+    @param in_file: input filepath
+    @param function: function applied to each frame, as in apply_without_ram_buffer
+    @param fps: frames per second the preview keeps up with
+    @param max_pixels: most pixels per preview frame
+    @param kwargs: parsed directly to function as **kwargs
+    @return: True if confirmed, False if dropped, None if there is no display, only the first frame is then
+        processed and written as a still, see Preview.show
+    """
+    capture = cv2.VideoCapture(in_file.__str__())
+    try:
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        level = Preview.pyramid_level((int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                       int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))), max_pixels)
+        kwargs = _scaled_kwargs(kwargs, level)
+        shown = False
+        while True:
+            start = time.perf_counter()
+            frame = 0
+            while frame < frame_count:
+                due = int((time.perf_counter() - start) * fps)
+                while frame < min(due, frame_count - 1):  # skip frames without converting them
+                    capture.grab()
+                    frame += 1
+                return_value, current_frame = capture.read()
+                frame += 1
+                if not return_value:
+                    break
+                with Profile.section('preview', 'video'):
+                    result = Contrast.apply(function, Preview.pyramid_down(current_frame, level), **kwargs)
+                key = Preview.show(result.astype('uint8'))
+                if key is None:
+                    return None
+                shown = True
+                if key in (13, ord('y')):
+                    return True
+                if key in (27, ord('q')):
+                    return False
+                delay = frame / fps - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if not shown:  # no frame could be read
+                return None
+            capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    finally:
+        capture.release()
+        if shown:
+            _destroy_windows()
+
+
+def preview_then_render(in_file: pathlib.Path, out_file: pathlib.Path, function: Callable, fps=30,
+                        max_pixels: int = Preview.default_max_pixels, **kwargs):
+    """
+    Preview a video, see preview_video, and once the parameters are confirmed queue the full resolution render in
+    the background, see Preview.queue_render. Without a display the parameters are confirmed at the prompt
+    @param kwargs: parsed to apply_without_ram_buffer and on to function
+    @return: Future of the render, None if not confirmed
+    """
+    confirmed = preview_video(in_file, function, fps, max_pixels,
+                              **{k: v for k, v in kwargs.items() if k not in _render_only_kwargs})
+    if confirmed is None:
+        confirmed = input("render at full resolution? y/n: ") == 'y'
+    if not confirmed:
+        return None
+    print(f"Full resolution render of {in_file} queued")
+    return Preview.queue_render(apply_without_ram_buffer, in_file, out_file, function, fps, **kwargs)
+
+
+# options of apply_without_ram_buffer that are not passed on to function
+_render_only_kwargs = {'output_size', 'padding_', 'view_', 'workers', 'queue_depth'}
+
+
+class TemporalStdev:
+    """
+    Per pixel standard deviation over the last [window] frames, e.g. motion and flicker maps.
+    Frames are kept in a ring buffer alongside running sums of x and x**2, each new frame adds itself to the sums
+    and removes the frame it replaces, so every frame costs O(pixels) whatever the window size.
+    """
+
+    def __init__(self, window: int):
+        """
+        :param window: number of frames the standard deviation is taken over
+        """
+        self.window = window
+        self.count = 0  # frames seen so far
+        self.ring: numpy.ndarray or None = None
+        self.sum_x: numpy.ndarray or None = None
+        self.sum_x2: numpy.ndarray or None = None
+
+    @Profile.stage('temporal_std', lambda self, frame: self.window)
+    def __call__(self, frame: numpy.ndarray) -> numpy.ndarray:
+        """
+        Add a frame and return the standard deviation of each pixel over the frames in the window,
+        until [window] frames have been added the window holds every frame seen so far
+        """
+        if self.ring is None:
+            # integer frames are summed exactly in int64 so the sums never drift
+            sum_dtype = numpy.int64 if numpy.issubdtype(frame.dtype, numpy.integer) else numpy.float64
+            self.ring = numpy.zeros((self.window,) + frame.shape, dtype=frame.dtype)
+            self.sum_x = numpy.zeros(frame.shape, dtype=sum_dtype)
+            self.sum_x2 = numpy.zeros(frame.shape, dtype=sum_dtype)
+
+        slot = self.ring[self.count % self.window]
+        if self.count >= self.window:  # remove the frame leaving the window
+            leaving = slot.astype(self.sum_x.dtype)
+            self.sum_x -= leaving
+            self.sum_x2 -= leaving * leaving
+        entering = frame.astype(self.sum_x.dtype)
+        self.sum_x += entering
+        self.sum_x2 += entering * entering
+        slot[:] = frame
+        self.count += 1
+
+        n = min(self.count, self.window)
+        numerator = self.sum_x2 * n
+        numerator -= self.sum_x * self.sum_x
+        return Contrast.stdev_from_sums(numerator, n * n, numpy.float64)
+
+
+def temporal_stdev(frames: Iterable[numpy.ndarray], window: int, min_count: int = 1):
+    """
+    Yield the moving standard deviation over time of a stream of frames, e.g. IO.iter_video(file)
+    :param frames: iterable of frames of the same shape
+    :param window: number of frames the standard deviation is taken over
+    :param min_count: frames needed before the first output, later outputs are produced for every frame
+    """
+    stdev = TemporalStdev(window)
+    for frame in frames:
+        result = stdev(frame)
+        if stdev.count >= min_count:
+            yield result
+
+
+def apply_temporal(in_file: pathlib.Path, out_file: pathlib.Path, frame_window: int,
+                   function: Callable or None = None, fps=30, min_count: int = 1, **kwargs) -> None:
+    """
+    Temporal contrast of a video, the input is streamed so the clip is never held in memory
+    @param in_file: input filepath
+    @param out_file: output filepath
+    @param frame_window: number of frames the standard deviation is taken over
+    @param function: optional spatial function applied to each temporal stdev frame, e.g. Contrast.moving_stdev
+    @param fps: output fps
+    @param min_count: frames needed before the first output frame
+    @param kwargs: parsed directly to function as **kwargs
+    """
+    frames = temporal_stdev(IO.iter_video(in_file), frame_window, min_count)
+    if function is not None:
+        frames = (Contrast.apply(function, frame, **kwargs) for frame in frames)
+    IO.export_video(out_file, frames, fps)
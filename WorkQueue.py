@@ -0,0 +1,141 @@
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterable
+
+
+class WorkQueue:
+    """
+    Files to process shared between worker processes on any number of machines through an sqlite database, e.g. on
+    a shared filesystem (one with working file locks, sqlite relies on them).
+    Workers claim files with a lease, a file whose lease runs out, because its worker died, is claimed again by
+    another worker. Failed files are retried until they have been attempted [max_attempts] times.
+    Files are stored relative to the folder of the database so nodes may mount the share at different paths.
+    """
+
+    def __init__(self, path: pathlib.Path or str, lease: float = 600, max_attempts: int = 3):
+        """
+        :param path: database file, created if missing
+        :param lease: seconds a claim lasts without being renewed
+        :param max_attempts: claims of a file before it is marked as failed
+        """
+        self.path = pathlib.Path(path)
+        self.root = self.path.parent.resolve()
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()  # the lease renewal thread shares the connection
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            file TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL)""")
+
+    def __repr__(self):
+        return f"WorkQueue({self.path.as_posix()}, {self.counts()})"
+
+    def close(self):
+        self.connection.close()
+
+    def _name(self, file: pathlib.Path) -> str:
+        file = file.resolve()
+        return file.relative_to(self.root).as_posix() if file.is_relative_to(self.root) else file.as_posix()
+
+    def file(self, name: str) -> pathlib.Path:
+        """ path of a queued file on this machine """
+        return self.root / name
+
+    def _transaction(self, statements: Callable) -> list:
+        """ run statements(cursor) in a write transaction, taking the database lock before reading """
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(cursor)
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            return result
+
+    def add(self, files: Iterable[pathlib.Path]) -> int:
+        """ queue files, files already in the queue keep their state, :return: number of files added """
+        rows = [(self._name(file), time.time()) for file in files]
+        return self._transaction(lambda cursor: cursor.executemany(
+            "INSERT OR IGNORE INTO tasks (file, updated) VALUES (?, ?)", rows).rowcount)
+
+    def claim(self, worker: str, count: int = 1) -> list[str]:
+        """
+        :param worker: name of the claiming worker, see worker_name
+        :return: up to [count] pending files, or files whose lease has run out, now leased to worker
+        """
+        def statements(cursor):
+            now = time.time()
+            cursor.execute("UPDATE tasks SET state = 'failed', error = 'lease expired', updated = ? "
+                           "WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                           (now, now, self.max_attempts))
+            names = [row[0] for row in cursor.execute(
+                "SELECT file FROM tasks WHERE state = 'pending' OR (state = 'running' AND lease_until < ?) "
+                "ORDER BY rowid LIMIT ?", (now, count))]
+            cursor.executemany("UPDATE tasks SET state = 'running', worker = ?, lease_until = ?, "
+                               "attempts = attempts + 1, updated = ? WHERE file = ?",
+                               [(worker, now + self.lease, now, name) for name in names])
+            return names
+        return self._transaction(statements)
+
+    def renew(self, worker: str, names: list[str]):
+        """ extend the lease of files held by worker """
+        now = time.time()
+        self._transaction(lambda cursor: cursor.executemany(
+            "UPDATE tasks SET lease_until = ? WHERE file = ? AND worker = ? AND state = 'running'",
+            [(now + self.lease, name, worker) for name in names]))
+
+    def complete(self, worker: str, name: str):
+        self._transaction(lambda cursor: cursor.execute(
+            "UPDATE tasks SET state = 'done', error = NULL, updated = ? WHERE file = ? AND worker = ?",
+            (time.time(), name, worker)))
+
+    def fail(self, worker: str, name: str, error: str):
+        """ return a file to the queue, or mark it failed once it has used all of its attempts """
+        self._transaction(lambda cursor: cursor.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, "
+            "updated = ? WHERE file = ? AND worker = ?", (self.max_attempts, error, time.time(), name, worker)))
+
+    def counts(self) -> dict[str, int]:
+        """ :return: number of files in each state """
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+
+    def failures(self) -> list[tuple[str, str]]:
+        """ :return: (file, last error) of every failed file """
+        with self.lock:
+            return self.connection.execute("SELECT file, error FROM tasks WHERE state = 'failed'").fetchall()
+
+
+def worker_name() -> str:
+    """ name unique to this process across machines """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseRenewal:
+    """ context manager renewing the lease of the files held by a worker every third of the lease time """
+
+    def __init__(self, queue: WorkQueue, worker: str, names: list[str]):
+        self.queue = queue
+        self.worker = worker
+        self.names = names
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(self.queue.lease / 3):
+            self.queue.renew(self.worker, self.names)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
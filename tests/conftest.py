@@ -0,0 +1,8 @@
+import os
+import pathlib
+import sys
+
+# the modules are flat scripts run from the repository root, IO lists TestFiles relative to it on import
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, root.as_posix())
+os.chdir(root)
@@ -0,0 +1,34 @@
+import pickle
+from functools import partial
+
+import numpy
+
+import Cache
+import IO
+import PresetMethods
+
+
+def test_pickle(tmp_path):
+    cache = Cache.DiskCache(tmp_path / 'cache')
+    cache.put('a' * 40, numpy.arange(12.0))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.lock is not cache.lock
+    numpy.testing.assert_array_equal(copy.get('a' * 40), numpy.arange(12.0))
+    copy.put('b' * 40, numpy.ones(3))
+    numpy.testing.assert_array_equal(cache.get('b' * 40), numpy.ones(3))
+
+
+def test_schedule_files_with_cache(tmp_path):
+    rng = numpy.random.default_rng(0)
+    files = []
+    for i in range(3):
+        files.append(tmp_path / f'{i}.png')
+        IO.export_image(files[-1], rng.integers(0, 256, (40 + i, 50, 3), numpy.uint8))
+    plan = PresetMethods.PresetPlan({'cont_8': PresetMethods.named_methods['cont_8']})
+    cache = Cache.DiskCache(tmp_path / 'cache')
+    function = partial(PresetMethods.apply_plan_to_file, plan=plan, cache=cache)
+    results = PresetMethods.schedule_files(function, files, plan.bytes_per_pixel(), workers=2)
+    assert set(results) == set(files)
+    for file in files:
+        assert PresetMethods.output_file(file, 'cont_8').is_file()
+    assert Cache.DiskCache(tmp_path / 'cache').size > 0  # written by the worker processes
@@ -0,0 +1,103 @@
+import numpy
+import pytest
+
+import Contrast
+
+
+def baseline_combine(array_list: list[numpy.ndarray], method: str) -> numpy.ndarray:
+    """ combine_array_list as it was before Combiner, on arrays already cropped to one size """
+    if method[0] == '-':
+        method = method[1:]
+        array_list = array_list[::-1]
+    if method == 'sum':
+        return sum(array_list)
+    if method == 'avg':
+        return sum(array_list) / len(array_list)
+    return sum([arr * 1 / len(array_list) * i + 1 for i, arr in enumerate(array_list)])
+
+
+def random_arrays(shapes: list[tuple], dtype) -> list[numpy.ndarray]:
+    rng = numpy.random.default_rng(0)
+    return [(rng.random(shape) * 100).astype(dtype) for shape in shapes]
+
+
+# taller than the row blocks Combiner works in, see Contrast._block_rows
+tall_shapes = [(1200, 64, 3), (1195, 61, 3), (1203, 66, 3), (1198, 64, 3)]
+
+
+def test_shapes_span_several_blocks():
+    out = numpy.empty(tall_shapes[0])
+    assert Contrast._block_rows(out, out.itemsize) * 2 < min(shape[0] for shape in tall_shapes)
+
+
+@pytest.mark.parametrize('method', Contrast.combine_method_options())
+@pytest.mark.parametrize('dtype', [numpy.float64, numpy.float32])
+def test_combine_matches_baseline(method, dtype):
+    arrays = random_arrays(tall_shapes, dtype)
+    expected = baseline_combine(Contrast.resize_list_of_arrays(arrays), method)
+    result = Contrast.combine_array_list(arrays, method)
+    assert result.shape == expected.shape == (1195, 61, 3)
+    assert result.dtype == expected.dtype
+    if method == '-dist':  # added in the given order rather than reversed, see Combiner
+        numpy.testing.assert_allclose(result, expected, rtol=1e-6 if dtype == numpy.float32 else 1e-12)
+    else:
+        numpy.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('method', Contrast.combine_method_options())
+def test_combiner_leaves_inputs_unchanged(method):
+    arrays = random_arrays(tall_shapes, numpy.float64)
+    copies = [arr.copy() for arr in arrays]
+    Contrast.combine_array_list(arrays, method)
+    for arr, copy in zip(arrays, copies):
+        numpy.testing.assert_array_equal(arr, copy)
+
+
+@pytest.mark.parametrize('method', Contrast.combine_method_options())
+def test_combine_two_dimensional(method):
+    arrays = random_arrays([(700, 90), (702, 87), (699, 91)], numpy.float64)
+    expected = baseline_combine(Contrast.resize_list_of_arrays(arrays), method)
+    numpy.testing.assert_allclose(Contrast.combine_array_list(arrays, method), expected, rtol=1e-12)
+
+
+def test_combiner_counts_arrays():
+    combiner = Contrast.Combiner('sum', 3)
+    combiner.add(numpy.ones((4, 4)))
+    with pytest.raises(ValueError):
+        combiner.result()
+
+
+def test_combiner_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        Contrast.Combiner('median', 2)
+
+
+def offset_image(shape: tuple) -> numpy.ndarray:
+    """ small variance on a large offset, the case plain running sums of x**2 lose to cancellation """
+    return 1e4 + numpy.random.default_rng(1).normal(0, 0.01, shape)
+
+
+@pytest.mark.parametrize('window', [5, 40])
+def test_prefix_sums_float_offset(window):
+    image = offset_image((60, 4000))
+    exact = numpy.lib.stride_tricks.sliding_window_view(image, window, axis=1).std(axis=-1)[:-window + 1]
+    result = Contrast.PrefixSumStdev(image)(window)
+    numpy.testing.assert_allclose(result, exact, rtol=1e-9)
+    # bottleneck updates a running mean, which is itself only good to around 1e-6 here
+    numpy.testing.assert_allclose(result, Contrast.moving_stdev(image, window), rtol=1e-5)
+
+
+@pytest.mark.parametrize('window', [5, 12])
+def test_summed_area_float_offset(window):
+    image = offset_image((80, 300, 3))
+    exact = numpy.lib.stride_tricks.sliding_window_view(image, (window, window), axis=(0, 1)).std(axis=(-1, -2))
+    numpy.testing.assert_allclose(Contrast.SummedAreaStdev(image)(window), exact, rtol=1e-9)
+
+
+def test_float_flat_region():
+    image = numpy.full((40, 500, 3), 1234.5678)
+    image[:, :100] += numpy.random.default_rng(2).normal(0, 1, (40, 100, 3))
+    cache = Contrast.ImageCache(image)
+    assert cache(7)[:, 200:].max() < 1e-6
+    assert cache(7, kernel='box2d')[:, 200:].max() < 1e-6
+    assert Contrast.ImageCache(image[:, 200:])(7).max() < 1e-9
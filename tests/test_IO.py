@@ -0,0 +1,83 @@
+import pathlib
+
+import cv2
+import numpy
+import pytest
+
+import IO
+
+
+def random_image(dtype) -> numpy.ndarray:
+    return (numpy.random.default_rng(0).random((37, 53, 3)) * 300 - 20).astype(dtype)
+
+
+@pytest.mark.parametrize('suffix', ['.tif', '.tiff'])
+@pytest.mark.parametrize('dtype', [numpy.float32, numpy.float64, numpy.uint16])
+def test_tiff_round_trip(tmp_path, suffix, dtype):
+    image = random_image(dtype)
+    file = tmp_path / f'out{suffix}'
+    IO.export_image(file, image)
+    loaded = cv2.imread(file.as_posix(), cv2.IMREAD_UNCHANGED)
+    assert loaded.dtype == image.dtype
+    numpy.testing.assert_array_equal(loaded, image)
+
+
+def test_uint16_png_round_trip(tmp_path):
+    image = random_image(numpy.uint16)
+    IO.export_image(tmp_path / 'out.png', image)
+    numpy.testing.assert_array_equal(cv2.imread((tmp_path / 'out.png').as_posix(), cv2.IMREAD_UNCHANGED), image)
+
+
+@pytest.mark.parametrize('suffix', ['.png', '.jpg'])
+def test_float_quantised_to_8_bits(tmp_path, suffix):
+    image = random_image(numpy.float64)
+    file = tmp_path / f'out{suffix}'
+    IO.export_image(file, image)
+    loaded = cv2.imread(file.as_posix(), cv2.IMREAD_UNCHANGED)
+    assert loaded.dtype == numpy.uint8
+    if suffix == '.png':
+        numpy.testing.assert_array_equal(loaded, IO.quantise(image))
+
+
+def test_normalise_quantises_float_tiff(tmp_path):
+    image = random_image(numpy.float32)
+    IO.export_image(tmp_path / 'out.tif', image, normalise=True)
+    loaded = cv2.imread((tmp_path / 'out.tif').as_posix(), cv2.IMREAD_UNCHANGED)
+    assert loaded.dtype == numpy.uint8 and loaded.min() == 0 and loaded.max() == 255
+
+
+def test_raw_round_trip(tmp_path):
+    image = random_image(numpy.float32)
+    IO.export_image(tmp_path / 'out.npy', image)
+    numpy.testing.assert_array_equal(IO.load_image(tmp_path / 'out.npy'), image)
+
+
+class _CopyingCapture:
+    """ capture that decodes into new arrays rather than the one it is given, as cv2 does when it can't reuse it """
+
+    def __init__(self, capture: cv2.VideoCapture):
+        self.capture = capture
+
+    def read(self, image=None):
+        return self.capture.read()
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+@pytest.mark.parametrize('copying', [False, True])
+def test_video_blocks(tmp_path, monkeypatch, copying):
+    file = tmp_path / 'clip.avi'
+    rng = numpy.random.default_rng(0)
+    IO.export_video(file, [rng.integers(0, 256, (48, 64, 3), numpy.uint8) for _ in range(7)])
+    frames = numpy.stack(list(IO.iter_video(file)))
+    if copying:
+        open_video = IO._open_video
+
+        def open_copying(video: pathlib.Path):
+            capture, *sizes = open_video(video)
+            return (_CopyingCapture(capture), *sizes)
+        monkeypatch.setattr(IO, '_open_video', open_copying)
+    blocks = list(IO.iter_video(file, 3))
+    assert [len(block) for block in blocks] == [3, 3, 1]
+    numpy.testing.assert_array_equal(numpy.concatenate(blocks), frames)
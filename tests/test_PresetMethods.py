@@ -0,0 +1,84 @@
+import numpy
+import pytest
+
+import Contrast
+import PresetMethods
+
+methods = {name: PresetMethods.named_methods[name] for name in ('cont_24', 'add_area')}
+methods['box'] = (([3, 5, 9], 'avg', 'box2d'), 7, 'dist')
+
+
+@pytest.fixture(scope='module')
+def plan():
+    return PresetMethods.PresetPlan(methods)
+
+
+def sample_image(dtype, seed: int = 0) -> numpy.ndarray:
+    image = numpy.random.default_rng(seed).integers(0, 256, (90, 110, 3), numpy.uint8)
+    return image if dtype == numpy.uint8 else image.astype(dtype) / 7 + 3000
+
+
+def assert_outputs_match(result: dict, expected: dict, dtype):
+    assert result.keys() == expected.keys()
+    for name in expected:
+        assert result[name].shape == expected[name].shape
+        if dtype == numpy.uint8:  # integer images are summed exactly, so any split gives the same bits
+            numpy.testing.assert_array_equal(result[name], expected[name], err_msg=name)
+        else:  # float running sums start again at each split
+            numpy.testing.assert_allclose(result[name], expected[name], rtol=0, err_msg=name,
+                                          atol=1e-12 * numpy.abs(expected[name]).max())
+
+
+split_runs = {
+    'tiles': lambda plan, image: dict(plan.apply(image, tile=32)),
+    'rectangular tiles': lambda plan, image: Contrast.apply_tiled(plan.outputs, image, plan.halo, (17, 23)),
+    'rows': lambda plan, image: dict(plan.apply(image, rows=16)),
+    'bands': lambda plan, image: dict(plan.apply(image, bands=3)),
+    'bands of rows': lambda plan, image: dict(plan.apply(image, bands=2, rows=16)),
+}
+
+
+@pytest.mark.parametrize('dtype', [numpy.uint8, numpy.float64])
+@pytest.mark.parametrize('split', split_runs)
+def test_split_matches_whole(plan, split, dtype):
+    image = sample_image(dtype)
+    assert_outputs_match(split_runs[split](plan, image), dict(plan.apply(image)), dtype)
+
+
+@pytest.mark.parametrize('dtype', [numpy.uint8, numpy.float64])
+@pytest.mark.parametrize('bands, rows', [(1, 0), (2, 0), (1, 16)])
+def test_batch_matches_whole(plan, dtype, bands, rows):
+    images = [sample_image(dtype, seed) for seed in range(3)]
+    for result, image in zip(plan.apply_batch(images, bands, rows), images):
+        assert_outputs_match(result, dict(plan.apply(image)), dtype)
+
+
+def test_stacked_matches_single():
+    images = [sample_image(numpy.uint8, seed) for seed in range(3)]
+    function = Contrast.moving_stdev
+    for result, image in zip(Contrast.apply_stacked(lambda stack: function(stack, 9), images), images):
+        numpy.testing.assert_array_equal(result, function(image, 9))
+
+
+@pytest.mark.parametrize('dtype', [numpy.uint8, numpy.float64])
+def test_float32_precision(dtype):
+    """ float32 results agree with float64 to within 1e-6 relative, see Contrast.ImageCache """
+    image = sample_image(dtype)
+    expected = dict(PresetMethods.PresetPlan(PresetMethods.named_methods).apply(image))
+    result = dict(PresetMethods.PresetPlan(PresetMethods.named_methods, 'float32').apply(image))
+    for name in expected:
+        assert result[name].dtype == numpy.float32 and expected[name].dtype == numpy.float64
+        numpy.testing.assert_allclose(result[name], expected[name], rtol=1e-6, err_msg=name)
+
+
+@pytest.mark.parametrize('max_bytes', [1, 2 ** 18, 2 ** 20])
+def test_memory_budget(max_bytes):
+    """ a budget only changes what is kept and computed again, never the outputs """
+    image = sample_image(numpy.uint8)
+    expected = dict(PresetMethods.PresetPlan(PresetMethods.named_methods).apply(image))
+    plan = PresetMethods.PresetPlan(PresetMethods.named_methods, max_bytes=max_bytes)
+    cache = plan.image_cache(image)
+    result = dict(plan.run(cache))
+    for name in expected:
+        numpy.testing.assert_array_equal(result[name], expected[name], err_msg=name)
+    assert cache.nbytes == 0  # every result and table is dropped after its last planned read
@@ -0,0 +1,49 @@
+from functools import partial
+
+import numpy
+import pytest
+
+import Contrast
+import Profile
+
+
+@pytest.fixture
+def profile():
+    Profile.enable()
+    yield Profile
+    Profile.disable()
+
+
+def test_apply_partial(profile):
+    image = numpy.arange(5 * 6 * 3, dtype=numpy.float64).reshape(5, 6, 3)
+    result = Contrast.apply(partial(numpy.multiply, 2), image)
+    numpy.testing.assert_array_equal(result, image * 2)
+    assert ('apply', 'partial') in {(row['stage'], row['detail']) for row in profile.summary()}
+
+
+def test_output_bytes(profile):
+    image = numpy.zeros((8, 8, 3))
+    Contrast.apply(numpy.negative, image)
+    row = next(row for row in profile.summary() if row['stage'] == 'apply')
+    assert row['output_bytes'] == image.nbytes
+    assert 'output MB' in profile.report()
+
+
+def test_allocated_bytes(profile):
+    image = numpy.zeros((64, 64, 3), numpy.uint8)
+    cache = Contrast.ImageCache(image)
+    cache.combine([3, 5], 'sum')
+    rows = {(row['stage'], row['detail']): row for row in profile.summary()}
+    table_bytes = 2 * (image.size + 64 * 3) * 8  # int64 running sums of x and x**2
+    assert rows[('prefix_sums', 'line')]['output_bytes'] == 0
+    assert rows[('prefix_sums', 'line')]['allocated_bytes'] >= table_bytes
+    assert rows[('combine', 'sum')]['allocated_bytes'] > 0
+    assert 'peak alloc MB' in profile.report()
+
+
+def test_banded_probe_excluded(profile):
+    image = numpy.random.default_rng(0).integers(0, 256, (200, 50, 3), numpy.uint8)
+    result = Contrast.apply_banded(partial(Contrast.moving_stdev, window=5), image, 4, 2)
+    stages = {row['stage'] for row in profile.summary()}
+    assert 'banded' in stages and 'move_std' not in stages
+    numpy.testing.assert_array_equal(result, Contrast.moving_stdev(image, 5))